@@ -15,6 +15,25 @@ import struct
 import string
 import time
 import types
+import select
+import socket
+import json
+import multiprocessing
+import threading
+import fcntl
+import errno
+import atexit
+import zlib
+import gc
+import functools
+import signal
+import colorsys
+import resource
+try:
+    from pygame._sdl2 import video
+except ImportError:
+    video = None # pygame 1.x, only the surface Screen is available
+from collections import OrderedDict, deque
 
 # random.seed()
 
@@ -32,9 +51,80 @@ SCREEN_SZ = (SCALED_SZ[0] // SCALE, SCALED_SZ[1] // SCALE)
 FONT = './data/fonts/Early GameBoy.ttf'
 TRANS = (255,0,255)
 EPSILON = 1 ** -4
+INTERP_DELAY = 0.1 # remote entities are shown this far (seconds) in the past
+MAX_REWIND = 0.25 # longest (seconds) flames are rewound for a lagging player
+EXTRAP_MAX = 0.25 # how long to dead reckon past the newest remote state
+MOVE_RATE = 15.0 # movement updates sent per second while moving
+MAX_INPUT_DT = 0.1 # longest step (seconds) a single input may move
+INPUT_BANK = 0.25 # most movement time (seconds) the server banks for a guy
+INPUT_REDUNDANCY = 3 # inputs per INPUT message, the newest and those before
+PLANT_TIMEOUT = 1.0 # seconds a predicted bomb waits for the server's echo
+TICK_RATE = 60.0 # server simulation ticks per second (--tick=N)
+MAX_TICK_LAG = 0.25 # a server further behind than this (seconds) skips ticks
+FIRE_FPS = 8.0 # explosion animation frames per second
+FIRE_FRAMES = 6 # explosion-toon frames, the last two are smoke
+FIRE_HURT_FRAMES = 4 # frames that still hurt
+STATS_INTERVAL = 10.0 # seconds between stats dumps (--stats)
+PORT = 11523
+RELAY_PORT = 11524 # spectators connect to relays here
+RELAY_PEERS = 512 # spectators per relay
+RELAY_DELAY = 2.0 # seconds spectators are behind the match (--delay=N)
+RELAY_RATE = 20.0 # relay ticks per second (--tick=N)
+STATS_PORT = 11525 # local-only telemetry socket (--stats-port=N)
+STATS_CLIENTS = 4 # stats connections answered at once, others wait
+STATS_BUFFER = 1 << 18 # most bytes a stats connection may have queued
+STATS_TIMEOUT = 1.0 # seconds a stats connection has to read its snapshot
+MAX_PEERS = 64 # connections a server accepts (players, relays, load tests)
+CHANNELS = 2 # enet channels: reliable events, then unreliable state
+PEER_RATE = 16384 # bytes per second the server sends each peer (--peer-rate=N)
+PEER_BURST = 0.1 # seconds of PEER_RATE an idle peer may save up
+MATCH_PLAYERS = 2 # players per match
+ARENA_PLAYERS = 16 # players per match with --arena, unless --arena=N
+WORKER_PORT = 11600 # sharded server workers listen on WORKER_PORT + n
+LOAD_INTERVAL = 1.0 # seconds between worker load reports
+IO_WAIT = 0.01 # longest the network thread sleeps between services
+ATLAS_W = 512 # width of the sprite atlas texture (--renderer)
+TRACE_EVENTS = 200000 # spans --trace keeps, older ones are dropped
+HITCH_BUDGET = 50 # ms a frame may take before --hitch dumps its stacks
+HITCH_INTERVAL = 10.0 # seconds between hitch dumps, at least
+SAMPLE_INTERVAL = 0.001 # CPU seconds between stack samples (--hitch)
 
 AXES = (0,1)
 
+MAP_MAGIC = b'BMAP'
+MAP_VERSION = 1
+MAP_HEADER = struct.Struct('<4sBHH') # magic, version, w, h
+MSG_HEADER = struct.Struct('<HB') # payload length, event
+PROTOCOL_VERSION = 4 # sent in INFO, bump on any change to Msg
+POS_SCALE = 16.0 # positions go over the wire in 1/16 pixels (int16)
+
+REPLAY_MAGIC = b'BRPL'
+REPLAY_VERSION = 2
+REPLAY_HEADER = struct.Struct('<4sBBB') # magic, version, profiles, arena
+REPLAY_ROUND = struct.Struct('<BBQ') # kind, fresh, seed; then scores
+REPLAY_TICK = struct.Struct('<Bd') # kind, t; then Input bits
+
+def option(name, default=None):
+    """Returns the value of a --name=value command line option."""
+    for arg in sys.argv[1:]:
+        if arg == '--' + name:
+            return True
+        if arg.startswith('--%s=' % name):
+            return arg[len(name)+3:]
+    return default
+
+# positional arguments (mode and address), options stripped
+ARGS = filter(lambda x: not x.startswith('--'), sys.argv[1:])
+
+def arena_players():
+    """Players in an --arena[=N] match, 0 outside arena mode."""
+    arena = option('arena')
+    if not arena:
+        return 0
+    if arena is True:
+        return ARENA_PLAYERS
+    return max(2, min(int(arena), MAX_PEERS))
+
 class Signal:
     def __init__(self):
         self.slots = {}
@@ -81,9 +171,331 @@ class Signal:
                     if force_brk:
                         return
 
+MASK64 = (1 << 64) - 1
+
+class Tracer(object):
+    """
+    Timeline of spans (--trace[=FILE], trace.json by default) kept in a
+    ring buffer of the last TRACE_EVENTS, written as Chrome trace_event
+    JSON (chrome://tracing, Perfetto) at exit and on F9.  When it's off,
+    span() returns one shared do-nothing context and traced() leaves
+    functions undecorated.
+    """
+    class Span(object):
+        __slots__ = ('events', 'name', 'args', 'start')
+        def __init__(self, events, name, args):
+            self.events = events
+            self.name = name
+            self.args = args
+        def __enter__(self):
+            self.start = time.time()
+        def __exit__(self, *exc):
+            self.events.append((self.name, self.args, self.start,
+                time.time(), threading.current_thread()))
+    
+    class Off(object):
+        def __enter__(self):
+            pass
+        def __exit__(self, *exc):
+            pass
+    
+    def __init__(self, fn=None):
+        self.fn = 'trace.json' if fn is True else fn
+        self.enabled = bool(fn)
+        self.events = deque(maxlen=TRACE_EVENTS) # (name, args, start, end, Thread)
+        self.off = Tracer.Off()
+        if self.enabled:
+            atexit.register(self.write)
+    
+    def span(self, name, args=None):
+        """Context timing its body as a span called name."""
+        if not self.enabled:
+            return self.off
+        return Tracer.Span(self.events, name, args)
+    
+    def traced(self, name):
+        """Decorator recording every call as a span."""
+        def decorate(func):
+            if not self.enabled:
+                return func
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorate
+    
+    def write(self):
+        pid = os.getpid()
+        events = []
+        threads = set()
+        for name, args, start, end, thread in list(self.events):
+            ev = {'name': name, 'ph': 'X', 'pid': pid, 'tid': thread.ident,
+                'ts': start * 1000000.0, 'dur': (end - start) * 1000000.0}
+            if args:
+                ev['args'] = args
+            events.append(ev)
+            threads.add(thread)
+        events += [{'name': 'thread_name', 'ph': 'M', 'pid': pid,
+            'tid': t.ident, 'args': {'name': t.name}} for t in threads]
+        with open(self.fn, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        print "Wrote %d spans to %s." % (len(self.events), self.fn)
+
+trace = Tracer(option('trace'))
+
+class Rng(object):
+    """
+    SplitMix64 generator.  Each match owns one seeded from net.seed and
+    splits it into named streams, so that map, drop and curse draws on
+    every machine come out the same no matter what else used randomness.
+    """
+    GAMMA = 0x9E3779B97F4A7C15
+    MIX1 = 0xBF58476D1CE4E5B9
+    MIX2 = 0x94D049BB133111EB
+
+    def __init__(self, seed):
+        self.state = seed & MASK64
+
+    def next(self):
+        self.state = (self.state + Rng.GAMMA) & MASK64
+        z = self.state
+        z = ((z ^ (z >> 30)) * Rng.MIX1) & MASK64
+        z = ((z ^ (z >> 27)) * Rng.MIX2) & MASK64
+        return z ^ (z >> 31)
+
+    def split(self, name):
+        """Independent stream for name, not affected by our own draws."""
+        return Rng(Rng(self.state ^ zlib.crc32(name) & 0xFFFFFFFF).next())
+
+    def random(self):
+        return (self.next() >> 11) * (1.0 / (1 << 53))
+
+    def randint(self, a, b):
+        return a + self.next() % (b - a + 1)
+
+    def choice(self, seq):
+        return seq[self.randint(0, len(seq) - 1)]
+
+    def random_sample(self, shape):
+        """
+        An array of random() draws, computed all at once in uint64 (which
+        wraps like the & MASK64 above), the same as drawing them one by one.
+        """
+        n = int(numpy.prod(shape))
+        u = numpy.uint64
+        z = u(self.state) + numpy.arange(1, n + 1, dtype=u) * u(Rng.GAMMA)
+        self.state = (self.state + n * Rng.GAMMA) & MASK64
+        z = (z ^ (z >> u(30))) * u(Rng.MIX1)
+        z = (z ^ (z >> u(27))) * u(Rng.MIX2)
+        z ^= z >> u(31)
+        return ((z >> u(11)) * (1.0 / (1 << 53))).reshape(shape)
+
+class AliasTable(object):
+    """Walker's alias method: O(1) weighted sampling from a fixed table."""
+    def __init__(self, weights):
+        n = len(weights)
+        total = float(sum(weights))
+        scaled = [w * n / total for w in weights]
+        self.prob = [1.0] * n
+        self.alias = range(n)
+        small = [i for i, w in enumerate(scaled) if w < 1.0]
+        large = [i for i, w in enumerate(scaled) if w >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+
+    def sample(self, rng):
+        i = rng.randint(0, len(self.prob) - 1)
+        return i if rng.random() < self.prob[i] else self.alias[i]
+
 def random_string(length):
     return ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(length))
 
+class Telemetry(object):
+    """
+    Network counters over Net: bytes and packets per second each way for
+    every peer, ENet's round trip time and packet loss, and message counts
+    and sizes per event type.  With --stats they are printed every
+    STATS_INTERVAL seconds and served as JSON on a local-only socket.
+    """
+
+    class Counter(object):
+        def __init__(self):
+            self.packets = 0
+            self.bytes = 0
+            self.last = (0, 0, time.time())
+            self.rate = (0.0, 0.0) # packets/s, bytes/s
+
+        def add(self, n):
+            self.packets += 1
+            self.bytes += n
+
+        def update(self, now):
+            packets, nbytes, then = self.last
+            dt = max(now - then, EPSILON)
+            self.rate = ((self.packets - packets) / dt, (self.bytes - nbytes) / dt)
+            self.last = (self.packets, self.bytes, now)
+
+        def as_dict(self):
+            return {
+                'packets': self.packets, 'bytes': self.bytes,
+                'packets_s': self.rate[0], 'bytes_s': self.rate[1]
+            }
+
+    def __init__(self, net, port=None):
+        self.net = net
+        self.enabled = bool(option('stats'))
+        self.started = time.time()
+        self.peers = {} # Net.Peer (None for the server, on clients) -> [in, out]
+        self.events = {} # (direction, ev) -> [count, bytes]
+        self.tick = None # TickStats, on servers
+        self.memory = None # Memory, with --mem
+        self.next_update = 0.0
+        self.next_dump = self.started + STATS_INTERVAL
+        self.socket = None
+        self.clients = [] # [socket, unsent bytes, deadline] being answered
+        if self.enabled:
+            self.listen(port or int(option('stats-port', STATS_PORT)))
+
+    def listen(self, port):
+        try:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind(('127.0.0.1', port))
+            self.socket.listen(4)
+            self.socket.setblocking(0)
+        except socket.error as e:
+            print "Stats socket unavailable on port %d: %s" % (port, e)
+            self.socket = None
+
+    def counters(self, peer):
+        c = self.peers.get(peer)
+        if c is None:
+            c = self.peers[peer] = [Telemetry.Counter(), Telemetry.Counter()]
+        return c
+
+    def event(self, direction, ev, n):
+        c = self.events.get((direction, ev))
+        if c is None:
+            c = self.events[(direction, ev)] = [0, 0]
+        c[0] += 1
+        c[1] += n
+
+    def received(self, peer, n):
+        self.counters(peer)[0].add(n)
+        if peer:
+            peer.last_recv = time.time()
+
+    def sent(self, peer, n):
+        if peer:
+            self.counters(peer)[1].add(n)
+        elif self.net.server:
+            # broadcast: one copy to every peer
+            for p in self.net.peers:
+                self.counters(p)[1].add(n)
+        else:
+            self.counters(None)[1].add(n)
+
+    def disconnect(self, peer):
+        self.peers.pop(peer, None)
+
+    def peer_dict(self, peer, counters):
+        if peer:
+            enet_peer = peer.peer
+            d = {'address': str(peer), 'player': peer.player_id,
+                'spectator': peer.spectator,
+                'idle': time.time() - peer.last_recv}
+        else:
+            enet_peer = self.net.socket
+            d = {'address': 'server'}
+        try:
+            d['rtt'] = enet_peer.roundTripTime
+            d['rtt_var'] = enet_peer.roundTripTimeVariance
+            d['loss'] = enet_peer.packetLoss / 65536.0 # ENET_PEER_PACKET_LOSS_SCALE
+        except (AttributeError, IOError):
+            pass
+        d['in'] = counters[0].as_dict()
+        d['out'] = counters[1].as_dict()
+        return d
+
+    def snapshot(self):
+        events = {}
+        for (direction, ev), (count, nbytes) in self.events.iteritems():
+            e = events.setdefault(Net.EVENT_NAMES.get(ev, str(ev)), {})
+            e[direction] = {'count': count, 'bytes': nbytes}
+        snap = {
+            'uptime': time.time() - self.started,
+            'peers': [self.peer_dict(p, c) for p, c in self.peers.iteritems()],
+            'events': events
+        }
+        if self.tick:
+            snap['tick'] = self.tick.as_dict()
+        if self.memory and self.memory.enabled:
+            snap['memory'] = self.memory.as_dict()
+        return snap
+
+    def dump(self):
+        snap = self.snapshot()
+        for p in snap['peers']:
+            print "%s: rtt %s ms, loss %.1f%%, in %.0f B/s (%.0f pkt/s), " \
+                "out %.0f B/s (%.0f pkt/s)" % (
+                p['address'], p.get('rtt', '?'), p.get('loss', 0.0) * 100.0,
+                p['in']['bytes_s'], p['in']['packets_s'],
+                p['out']['bytes_s'], p['out']['packets_s'])
+        for name, e in sorted(snap['events'].items(),
+            key=lambda x: -sum(d['bytes'] for d in x[1].values())):
+            print "  %-10s" % name + "".join(
+                " %s %d msgs/%d B" % (direction, d['count'], d['bytes'])
+                for direction, d in sorted(e.items()))
+
+    def serve(self):
+        # never block the tick on a slow reader: queue the snapshot and send
+        # what the socket takes, dropping readers that fall too far behind
+        now = time.time()
+        while len(self.clients) < STATS_CLIENTS:
+            try:
+                conn, _ = self.socket.accept()
+            except socket.error:
+                break
+            conn.setblocking(0)
+            data = json.dumps(self.snapshot()) + '\n'
+            if len(data) > STATS_BUFFER:
+                print "Stats snapshot too large (%d bytes)." % len(data)
+                conn.close()
+                continue
+            self.clients += [[conn, data, now + STATS_TIMEOUT]]
+        for client in self.clients:
+            conn, data, deadline = client
+            try:
+                data = data[conn.send(data):]
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    data = ''
+            if not data or now >= deadline:
+                conn.close()
+                data = ''
+            client[1] = data
+        self.clients = filter(lambda c: c[1], self.clients)
+
+    def update(self):
+        now = time.time()
+        if now >= self.next_update:
+            for counters in self.peers.itervalues():
+                counters[0].update(now)
+                counters[1].update(now)
+            self.next_update = now + 1.0
+        if not self.enabled:
+            return
+        if self.socket:
+            self.serve()
+        if now >= self.next_dump:
+            self.dump()
+            self.next_dump = now + STATS_INTERVAL
+
 class Net:
     class Event:
         INFO = 0
@@ -95,12 +507,23 @@ class Net:
         GIVE = 6
         SPAWN = 7
         MULTIPLANT = 8
+        KICK = 9
+        INPUT = 10
+        REDIRECT = 11
+    
+    EVENT_NAMES = dict((v, k) for k, v in vars(Event).items()
+        if not k.startswith('_'))
+
+    # connect data telling the server a peer only watches
+    SPECTATE = 1
 
     class Peer:
-        def __init__(self, peer, player_id=-1):
+        def __init__(self, peer, player_id=-1, spectator=False):
             self.peer = peer
             self.player_id = player_id
+            self.spectator = spectator
             self.last_recv = time.time()
+            self.allowance = 0.0 # bytes we may still send it (server)
 
         # def timeout(self):
         #     return (time.time() - self.last_recv > 5.0)
@@ -111,62 +534,204 @@ class Net:
     def __init__(self):
         self.server = False
         self.generate_seed()
-        random.randint(0,255)
         try:
-            self.server = (sys.argv[1] == '-s')
+            self.server = (ARGS[0] == '-s')
         except:
             pass
 
         self.client = False
+        self.relay = False # address of the server we relay
+        self.spectator = False
+        self.loadtest = False # address of the server we load
         if not self.server:
             try:
-                self.client = sys.argv[1]
+                if ARGS[0] == '-r':
+                    self.relay = ARGS[1]
+                elif ARGS[0] == '-l':
+                    self.loadtest = ARGS[1] if len(ARGS) > 1 else b"localhost"
+                elif ARGS[0] == '-w':
+                    self.client = ARGS[1]
+                    self.spectator = True
+                else:
+                    self.client = ARGS[0]
             except:
                 pass
 
-        self.local = not self.server and not self.client
+        self.local = not (self.server or self.client or self.relay or self.loadtest)
         self.online = not self.local
 
         self.socket = None
         if self.server:
-            self.host = enet.Host(enet.Address(b"localhost", 11523), 10, 0, 0, 0)
+            self.listen(PORT)
         if self.client:
-            self.host = enet.Host(None, 1, 1, 0, 0)
-            self.socket = self.host.connect(enet.Address(b"localhost", 11523), 1)
+            # room for a second connection while being redirected
+            self.host = enet.Host(None, 2, CHANNELS, 0, 0)
+            if self.spectator:
+                self.socket = self.host.connect(
+                    enet.Address(self.client, RELAY_PORT), CHANNELS, Net.SPECTATE)
+            else:
+                self.socket = self.host.connect(
+                    enet.Address(self.client, PORT), CHANNELS)
     
         self.peers = []
+        # outgoing messages for this tick, per (peer, flags)
+        # peer is None for broadcasts
+        self.queue = OrderedDict()
+        # latest state per Net.Peer, (event, key) -> (msg, values), waiting
+        # for room in that peer's budget (server)
+        self.state = {}
+        self.peer_rate = float(option('peer-rate', PEER_RATE))
+        self.last_flush = time.time()
 
         self.on_connect = Signal()
         self.on_disconnect = Signal()
         self.on_packet = Signal()
 
+        # the host is serviced on its own thread unless --net-thread=0,
+        # the simulation only touches these queues
+        self.threaded = self.online and option('net-thread', '1') != '0'
+        self.thread = None
+        self.inbound = deque() # (type, enet peer, data) from the thread
+        self.outbound = deque() # callables run on the thread
+
+        self.telemetry = Telemetry(self)
+
+    def listen(self, port):
+        self.host = enet.Host(enet.Address(b"localhost", port), MAX_PEERS, 0, 0, 0)
+
+    def redirect(self, port):
+        """Moves a client over to another port on the same server."""
+        print "Redirected to port %d." % port
+        def connect():
+            self.socket = self.host.connect(enet.Address(self.client, port),
+                CHANNELS, Net.SPECTATE if self.spectator else 0)
+        self.call(connect)
+
     def generate_seed(self):
-        self.seed = random.randint(0,255)
+        self.seed = random.getrandbits(32)
         
-    def poll(self):
-        event = self.host.service(1)
-        if event.type == enet.EVENT_TYPE_CONNECT:
+    def start(self):
+        """Starts the network thread, once we have our final host."""
+        if self.thread:
+            return
+        self.wake_main = self.pipe()
+        self.wake_io = self.pipe()
+        self.thread = threading.Thread(target=self.run, name="net")
+        self.thread.daemon = True
+        self.running = True
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        self.running = False
+        os.write(self.wake_io[1], b'!')
+        self.thread.join(1.0)
+
+    @staticmethod
+    def pipe():
+        r, w = os.pipe()
+        fcntl.fcntl(r, fcntl.F_SETFL, fcntl.fcntl(r, fcntl.F_GETFL) | os.O_NONBLOCK)
+        return r, w
+
+    @staticmethod
+    def wait(fds, timeout):
+        try:
+            select.select(fds, [], [], timeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+    @staticmethod
+    def drain(fd):
+        try:
+            os.read(fd, 4096)
+        except OSError:
+            pass
+
+    def run(self):
+        # network thread: the only place the host is used once started.
+        # host.service holds the GIL, so sleep in select and only service
+        # once there is something to do.
+        sockets = [self.host.socket.fileno(), self.wake_io[0]]
+        while self.running:
+            self.wait(sockets, IO_WAIT)
+            self.drain(self.wake_io[0])
+            with trace.span('Net.service'):
+                while self.outbound:
+                    self.outbound.popleft()()
+                arrived = False
+                event = self.host.service(0)
+                while event.type != enet.EVENT_TYPE_NONE:
+                    if event.type == enet.EVENT_TYPE_RECEIVE:
+                        data = event.packet.data
+                    else:
+                        data = event.data
+                    self.inbound.append((event.type, event.peer, data))
+                    arrived = True
+                    event = self.host.service(0)
+            if arrived:
+                os.write(self.wake_main[1], b'!')
+
+    def call(self, func):
+        """Runs func with the host, on the network thread if there is one."""
+        if self.threaded:
+            self.start()
+            self.outbound.append(func)
+            os.write(self.wake_io[1], b'!')
+        else:
+            func()
+
+    @trace.traced('Net.poll')
+    def poll(self, timeout=0):
+        """
+        Handles everything that has arrived, waiting up to timeout ms for
+        the first event.
+        """
+        if self.threaded:
+            self.start()
+            if not self.inbound and timeout:
+                self.wait([self.wake_main[0]], timeout * 0.001)
+            self.drain(self.wake_main[0])
+            while self.inbound:
+                self.handle(*self.inbound.popleft())
+            return
+        event = self.host.service(timeout)
+        while event.type != enet.EVENT_TYPE_NONE:
+            if event.type == enet.EVENT_TYPE_RECEIVE:
+                self.handle(event.type, event.peer, event.packet.data)
+            else:
+                self.handle(event.type, event.peer, event.data)
+            event = self.host.service(0)
+
+    def handle(self, kind, enet_peer, data):
+        if kind == enet.EVENT_TYPE_CONNECT:
             if self.server:
-                print "%s connected." % event.peer.host.address
-                self.peers += [Net.Peer(event.peer)]
-                self.on_connect(self.peer(event.peer))
+                print "%s connected." % enet_peer.host.address
+                self.peers += [Net.Peer(enet_peer,
+                    spectator=(data == Net.SPECTATE))]
+                self.on_connect(self.peer(enet_peer))
             else:
                 self.on_connect()
                 print "Connected."
             pass
-        elif event.type == enet.EVENT_TYPE_DISCONNECT:
+        elif kind == enet.EVENT_TYPE_DISCONNECT:
             if self.server:
-                print "%s disconnected." % event.peer.host.address
-                self.on_disconnect(self.peer(event.peer))
-                self.peers = filter(lambda x: x.peer != event.peer, self.peers)
+                print "%s disconnected." % enet_peer.host.address
+                peer = self.peer(enet_peer)
+                self.on_disconnect(peer)
+                self.telemetry.disconnect(peer)
+                self.peers = filter(lambda x: x != peer, self.peers)
+                for key in self.queue.keys():
+                    if key[0] == peer:
+                        del self.queue[key]
+                self.state.pop(peer, None)
             else:
                 print "Disconnected."
                 self.on_disconnect()
-        elif event.type == enet.EVENT_TYPE_RECEIVE:
-            if self.server:
-                self.recv(event.packet.data, self.peer(event.peer))
-            else:
-                self.recv(event.packet.data, None)
+        elif kind == enet.EVENT_TYPE_RECEIVE:
+            peer = self.peer(enet_peer) if self.server else None
+            self.telemetry.received(peer, len(data))
+            self.recv(data, peer)
         
         # timeout clients
         # self.timed_out = filter(lambda x: x.timeout(), self.peers)
@@ -175,55 +740,264 @@ class Net:
         #     print "%s timed out." % peer
     
     def peer(self, peer):
+        # enet peers compare by address, which several connections from one
+        # host (like a load test) share, so match the slot instead
         for p in self.peers:
-            if p.peer == peer:
+            if p.peer.incomingPeerID == peer.incomingPeerID:
                 return p
-        assert False
-        return None
+        raise KeyError(peer.incomingPeerID)
 
-    def send(self, peer, ev, data, flags=0):
-        buf = struct.pack('H', ev)
-        buf += data
-        packet = enet.Packet(buf, flags)
-        peer.peer.send(0, packet)
+    @staticmethod
+    def channel(flags):
+        """Reliable events and unreliable state don't queue behind each other."""
+        return 0 if flags & enet.PACKET_FLAG_RELIABLE else 1
+
+    def send(self, peer, msg, *values):
+        self.enqueue(peer, msg, values)
     
-    def broadcast(self, ev, data, flags=0):
-        buf = struct.pack('H', ev)
-        buf += data
-        packet = enet.Packet(buf, flags)
-        self.host.broadcast(0, packet)
+    def broadcast(self, msg, *values):
+        self.enqueue(None, msg, values)
+
+    def enqueue(self, peer, msg, values):
+        if self.server and msg.merge is not None:
+            # only the latest state matters, newer values take the old
+            # ones' place in line
+            key = (msg.event, values[msg.merge])
+            for p in [peer] if peer else self.peers:
+                state = self.state.setdefault(p, OrderedDict())
+                if key in state:
+                    self.telemetry.event('merged', msg.event,
+                        MSG_HEADER.size + msg.size)
+                state[key] = (msg, values)
+            return
+        key = (peer, msg.flags)
+        q = self.queue.get(key)
+        if q is None:
+            q = self.queue[key] = bytearray()
+        msg.write(q, values)
+        self.telemetry.event('out', msg.event, MSG_HEADER.size + msg.size)
+
+    def flush(self):
+        """
+        Sends everything queued this tick, one length-prefixed packet per
+        peer and flags, in the order the queues were first used.  On the
+        server, events always go out and count against each peer's budget
+        of --peer-rate bytes per second; pending state follows, oldest
+        first, while the budget lasts.  The rest waits for the next tick.
+        """
+        self.telemetry.update()
+        now = time.time()
+        if self.server:
+            for p in self.peers:
+                p.allowance = min(p.allowance +
+                    (now - self.last_flush) * self.peer_rate,
+                    self.peer_rate * PEER_BURST)
+        self.last_flush = now
+        packets = []
+        for (peer, flags), q in self.queue.iteritems():
+            buf = bytes(q)
+            self.telemetry.sent(peer, len(buf))
+            if self.server:
+                for p in [peer] if peer else self.peers:
+                    p.allowance -= len(buf)
+            packets += [(peer, Net.channel(flags), enet.Packet(buf, flags))]
+        self.queue.clear()
+        for peer, state in self.state.iteritems():
+            buf = bytearray()
+            while state:
+                key = next(iter(state))
+                msg, values = state[key]
+                n = MSG_HEADER.size + msg.size
+                if n > peer.allowance:
+                    break
+                msg.write(buf, values)
+                self.telemetry.event('out', msg.event, n)
+                peer.allowance -= n
+                del state[key]
+            if buf:
+                self.telemetry.sent(peer, len(buf))
+                packets += [(peer, Net.channel(0), enet.Packet(bytes(buf), 0))]
+        if packets:
+            self.call(lambda: self.send_packets(packets))
+
+    def send_packets(self, packets):
+        for peer, channel, packet in packets:
+            if peer:
+                peer.peer.send(channel, packet)
+            else:
+                self.host.broadcast(channel, packet)
+        self.host.flush()
 
     def recv(self, buf, peer):
-        tup = struct.unpack('H', buf[:2])
-        buf = buf[2:]
-        self.on_packet(tup[0], buf, peer)
+        view = memoryview(buf) # payloads are handed out without copies
+        ofs = 0
+        while ofs < len(buf):
+            sz, ev = MSG_HEADER.unpack_from(buf, ofs)
+            self.telemetry.event('in', ev, MSG_HEADER.size + sz)
+            ofs += MSG_HEADER.size
+            data = view[ofs:ofs+sz]
+            if trace.enabled: # no name or args to build otherwise
+                with trace.span(Net.EVENT_NAMES.get(ev, 'packet'), {'bytes': sz}):
+                    self.on_packet(ev, data, peer)
+            else:
+                self.on_packet(ev, data, peer)
+            ofs += sz
+
+class Message(object):
+    """
+    Layout of one message: its event, enet flags and (name, code) fields,
+    packed little-endian without padding by one precompiled Struct.
+    Fields coded 'pos' are pixel positions or velocities, sent as int16
+    in 1/POS_SCALE pixels.  Unreliable state with merge='field' is sent by
+    the server as bandwidth allows, only the latest per value of that field.
+    """
+    def __init__(self, event, flags, *fields, **kwargs):
+        self.event = event
+        self.flags = flags
+        self.channel = Net.channel(flags)
+        self.names = tuple(name for name, code in fields)
+        merge = kwargs.get('merge')
+        self.merge = self.names.index(merge) if merge else None
+        self.scaled = tuple(i for i, (name, code) in enumerate(fields)
+            if code == 'pos')
+        self.struct = struct.Struct('<' + ''.join(
+            'h' if code == 'pos' else code for name, code in fields))
+        self.size = self.struct.size
+        self.blank = b'\0' * (MSG_HEADER.size + self.size)
+    
+    def write(self, buf, values):
+        """Appends the message, header and all, to bytearray buf."""
+        if self.scaled:
+            values = list(values)
+            for i in self.scaled:
+                values[i] = max(-0x8000, min(0x7FFF,
+                    int(round(values[i] * POS_SCALE))))
+        ofs = len(buf)
+        buf.extend(self.blank)
+        MSG_HEADER.pack_into(buf, ofs, self.size, self.event)
+        self.struct.pack_into(buf, ofs + MSG_HEADER.size, *values)
+    
+    def read(self, data, ofs=0):
+        """Fields from a str, bytearray or memoryview, without copying it."""
+        values = self.struct.unpack_from(data, ofs)
+        if self.scaled:
+            values = list(values)
+            for i in self.scaled:
+                values[i] /= POS_SCALE
+        return values
+
+class Msg:
+    """
+    The protocol: every message layout.  Events a client sends and the
+    server passes on with the sender's player number have one layout each
+    way (PLANT from a client, PLANTED to everyone).
+    """
+    R = enet.PACKET_FLAG_RELIABLE
+    INFO = Message(Net.Event.INFO, R, ('version', 'B'), ('player', 'B'),
+        ('map', 'I'))
+    NEXT = Message(Net.Event.NEXT, R,
+        ('players', 'B'), ('seed', 'I'), ('scored', 'B'))
+    # the newest input is seq, bits0 and ms0, then the ones before it
+    INPUT = Message(Net.Event.INPUT, 0, ('seed', 'B'), ('seq', 'I'),
+        *[(name % n, 'B') for n in xrange(INPUT_REDUNDANCY)
+            for name in ('bits%d', 'ms%d')])
+    MOVE = Message(Net.Event.MOVE, 0, ('player', 'B'), ('seq', 'I'),
+        ('x', 'pos'), ('y', 'pos'), ('vx', 'pos'), ('vy', 'pos'),
+        merge='player')
+    PLANT = Message(Net.Event.PLANT, R, ('x', 'pos'), ('y', 'pos'))
+    PLANTED = Message(Net.Event.PLANT, R,
+        ('player', 'B'), ('x', 'pos'), ('y', 'pos'))
+    MULTIPLANT = Message(Net.Event.MULTIPLANT, R,
+        ('x', 'pos'), ('y', 'pos'), ('direction', 'B'))
+    MULTIPLANTED = Message(Net.Event.MULTIPLANT, R,
+        ('player', 'B'), ('x', 'pos'), ('y', 'pos'), ('direction', 'B'))
+    TRIGGER = Message(Net.Event.TRIGGER, R)
+    TRIGGERED = Message(Net.Event.TRIGGER, R, ('player', 'B'))
+    KICK = Message(Net.Event.KICK, R, ('player', 'B'),
+        ('x', 'pos'), ('y', 'pos'), ('vx', 'pos'), ('vy', 'pos'))
+    GIVE = Message(Net.Event.GIVE, R,
+        ('player', 'B'), ('item', 'B'), ('curse', 'B'))
+    KILL = Message(Net.Event.KILL, R, ('player', 'B'))
+    SPAWN = Message(Net.Event.SPAWN, R,
+        ('item', 'B'), ('x', 'pos'), ('y', 'pos'))
+    REDIRECT = Message(Net.Event.REDIRECT, R, ('port', 'H'))
 
 net = Net()
 
 def sgn(a):
     return (a > 0) - (a < 0)
 
-def load_image(fn):
+sprites = weakref.WeakSet() # live images and tiles, for RendererScreen's atlas
+
+def load_image(fn, sprite=True):
     if net and net.server:
         return None
     img = pygame.image.load(fn).convert()
-    img.set_colorkey(TRANS)
+    img.set_colorkey(TRANS, pygame.RLEACCEL)
+    if sprite:
+        sprites.add(img)
     return img
 
 def tileset(fn, **kwargs):
     if net.server:
         return []
-    img = load_image(fn)
+    img = load_image(fn, False)
     w, h = img.get_size()
     tiles = []
     hflip = kwargs.get('hflip', False)
     vflip = kwargs.get('vflip', False)
+    # rle=False for tiles still to be drawn on, RLE surfaces decode per lock
+    flags = pygame.RLEACCEL if kwargs.get('rle', True) else 0
     for i in xrange(0, w, h):
         tiles += [img.subsurface((i,0,h,h))]
         tiles[-1] = pygame.transform.flip(tiles[-1], hflip, vflip)
-        tiles[-1].set_colorkey(TRANS)
+        tiles[-1].set_colorkey(TRANS, flags)
+    sprites.update(tiles)
     return tiles
 
+class Interp(object):
+    """
+    Buffer of timestamped (pos, vel) states for an entity driven by the
+    network.  Sampling interpolates between the states around the given
+    time, or dead reckons from the newest velocity for up to 'limit'
+    seconds (forever if None) when the data hasn't arrived yet.
+    """
+    def __init__(self, limit=EXTRAP_MAX, size=16):
+        self.limit = limit
+        self.states = deque(maxlen=size)
+
+    def __len__(self):
+        return len(self.states)
+
+    def push(self, t, pos, vel):
+        if self.states and t <= self.states[-1][0]:
+            return # out of order
+        self.states.append((t, Vector2(pos.x, pos.y), Vector2(vel.x, vel.y)))
+
+    def clear(self):
+        self.states.clear()
+
+    def sample(self, t):
+        if not self.states:
+            return None
+        
+        # forget states we have already passed
+        while len(self.states) >= 2 and self.states[1][0] <= t:
+            self.states.popleft()
+        
+        t0, pos0, vel0 = self.states[0]
+        if t <= t0:
+            return copy(pos0), copy(vel0)
+        if len(self.states) >= 2:
+            t1, pos1, vel1 = self.states[1]
+            a = (t - t0) / (t1 - t0)
+            return pos0 + (pos1 - pos0) * a, copy(vel1)
+
+        dt = t - t0
+        if self.limit is not None:
+            dt = min(dt, self.limit)
+        return pos0 + vel0 * dt, copy(vel0)
+
 class Object(object):
     def __init__(self, **kwargs):
         self.game = kwargs.get('game')
@@ -257,19 +1031,28 @@ class Object(object):
     def mask(self):
         return self.rect()
     
+    def box(self):
+        """mask() as an (x, y, w, h) tuple, for the movement resolver."""
+        return tuple(self.mask())
+    
     def logic(self, t):
         if self.vel.magnitude() >= EPSILON:
             self.pos += self.vel * t
-        
-        if self.pos.x < -self.sz.x or self.pos.x >= self.game.world.sz.x:
-            self.attached = False
-        elif self.pos.y < -self.sz.y or self.pos.y >= self.game.world.sz.y:
-            self.attached = False
+        self.check_bounds()
+    
+    def check_bounds(self):
+        world = self.game.world
+        if self.pos.x < -self.sz.x or self.pos.x >= world.sz.x or \
+            self.pos.y < -self.sz.y or self.pos.y >= world.sz.y:
+            world.detach(self)
     
     def render(self, view):
         assert self.surface
         if self.attached and self.surface:
-            self.game.screen.buf.blit(self.surface, self.pos + self.ofs - view)
+            self.game.screen.batch.append((self.surface, (
+                self.pos.x + self.ofs.x - view.x,
+                self.pos.y + self.ofs.y - view.y
+            )))
 
     def collision(self):
         objs = self.game.world.objects
@@ -281,12 +1064,15 @@ class Object(object):
         return False
     
     def colliders(self):
+        """Objects (not walls) overlapping our mask."""
+        mask = self.mask()
+        world = self.game.world
         cols = []
-        objs = self.game.world.objects
-        objs = filter(lambda x: x != self and x.attached, objs)
-        for o in objs:
-            if self.mask().colliderect(o.mask()):
-                cols += [o]
+        for o in world.objects:
+            # guys walk through each other
+            if o is not self and o.attached and not isinstance(o, Guy):
+                if mask.colliderect(o.mask()):
+                    cols += [o]
         return cols
 
 class Item(Object):
@@ -339,32 +1125,6 @@ class Item(Object):
             if not net.server:
                 self.surface = self.surfaces[a]
     
-class Wall(Object):
-    def __init__(self, **kwargs):
-        super(self.__class__, self).__init__(**kwargs)
-    
-    def explode(self, item=None):
-        if self.breakable:
-            if not net.client:
-                if not item:
-                    item = self.game.world.random_item(game=self.game, pos=self.pos, sz=TILE_SZ_T, solid=False)
-                else:
-                    item = self.items(item, game=self.game, pos=self.pos, sz=TILE_SZ_T, solid=False)
-                if item:
-                    self.game.world.attach(item)
-                if net.online:
-                    # if item:
-                    #     print('Send item: %s' % item)
-                    self.send(item, self.pos)
-            self.attached = False
-
-    def send(self, item, pos):
-        net.broadcast(Net.Event.SPAWN,
-            struct.pack('=Bff',
-                item.item_id if item else Item.NoItem, pos.x, pos.y
-            ), enet.PACKET_FLAG_RELIABLE
-        )
-
 class Screen(Object):
     def __init__(self,screen,**kwargs):
         super(self.__class__, self).__init__(**kwargs)
@@ -374,46 +1134,94 @@ class Screen(Object):
         self.buf = pygame.Surface(SCREEN_SZ).convert()
         self.surface = pygame.Surface(SCALED_SZ).convert()
         self.screen = screen
+        self.batch = [] # (surface, pos) pairs waiting for flush()
+    
+    def flush(self):
+        """Draw every queued sprite to buf in one blits() call."""
+        if self.batch:
+            self.buf.blits(self.batch, False)
+            del self.batch[:]
     
     def render(self):
         pygame.transform.scale(self.buf, SCALED_SZ, self.surface)
         self.screen.blit(self.surface, (0,0))
+        pygame.display.flip()
 
-class Splode(Object):
+class RendererScreen(Object):
+    """
+    Screen drawn through an SDL2 Renderer (--renderer).  Sprites are
+    drawn from one atlas texture holding every loaded image, and the
+    renderer's logical size does the upscaling.  Whatever modes draw
+    straight to buf (backgrounds, text) is uploaded as a layer under the
+    sprites at each flush() and over them at render().  Uses a hardware
+    renderer when there is one and SDL's software renderer otherwise.
+    """
     def __init__(self, **kwargs):
         super(self.__class__, self).__init__(**kwargs)
         
-        self.surfaces = self.game.world.splode
-        
-        self.anim_point = 0.0
-        self.anim_speed = 8.0
-        self.frames = {
-            "default": [0,1,2,3,4,5]
-        }
-        self.state = "default"
-        if not net.server:
-            self.surface = self.surfaces[self.frames[self.state][0]]
-        self.solid = False
-        self.hurt = True
-
-        #self.life = 0.0
-
-    def logic(self, t):
-
-        #self.life += t
-        #if self.life >= 1.0:
-        #    self.attached = False
-        
-        self.anim_point += t * self.anim_speed
-        if self.anim_point >= len(self.frames[self.state])-1:
-            self.anim_point = 0.0
-            self.attached = False
-        a = int(round(self.anim_point))
-        if a > 3: # smoke frames no longer damage
-            self.hurt = False
-        if not net.server:
-            self.surface = self.surfaces[self.frames[self.state][a]]
+        self.pos = Vector2(0.0, 0.0)
+        self.sz = Vector2(SCREEN_SZ[0], SCREEN_SZ[1])
+        self.window = video.Window(TITLE, SCALED_SZ)
+        self.renderer = video.Renderer(self.window, accelerated=-1)
+        self.renderer.logical_size = SCREEN_SZ
+        self.buf = pygame.Surface(SCREEN_SZ, pygame.SRCALPHA, 32)
+        self.layers = [self.layer(), self.layer()] # under, over sprites
+        self.batch = [] # (surface, pos) pairs waiting for flush()
+        self.regions = weakref.WeakKeyDictionary() # surface -> (texture, rect)
+        self.pack()
     
+    def layer(self):
+        tex = video.Texture(self.renderer, SCREEN_SZ, streaming=True)
+        tex.blend_mode = 1 # SDL_BLENDMODE_BLEND
+        return tex
+    
+    def pack(self):
+        """(Re)builds the atlas from every sprite loaded so far."""
+        x = y = row = 0
+        rects = []
+        for img in sorted(sprites, key=lambda s: -s.get_height()):
+            w, h = img.get_size()
+            if x + w > ATLAS_W:
+                x, y, row = 0, y + row, 0
+            rects.append((img, pygame.Rect(x, y, w, h)))
+            x += w
+            row = max(row, h)
+        atlas = pygame.Surface((ATLAS_W, max(y + row, 1)), pygame.SRCALPHA, 32)
+        for img, rect in rects:
+            atlas.blit(img, rect)
+        tex = video.Texture.from_surface(self.renderer, atlas)
+        self.regions = weakref.WeakKeyDictionary(
+            (img, (tex, rect)) for img, rect in rects)
+    
+    def region(self, surface):
+        if surface not in self.regions:
+            if surface in sprites:
+                self.pack()
+            else:
+                # not a loaded image, give it a texture of its own
+                tex = video.Texture.from_surface(self.renderer, surface)
+                self.regions[surface] = (tex, surface.get_rect())
+        return self.regions[surface]
+    
+    def upload(self, layer):
+        """Draws what is on buf so far, then clears it for the next layer."""
+        tex = self.layers[layer]
+        tex.update(self.buf)
+        tex.draw()
+        self.buf.fill((0,0,0,0))
+    
+    def flush(self):
+        self.upload(0)
+        for surface, pos in self.batch:
+            tex, src = self.region(surface)
+            tex.draw(src, (int(pos[0]), int(pos[1]), src.w, src.h))
+        del self.batch[:]
+    
+    def render(self):
+        self.upload(1)
+        self.renderer.present()
+        self.renderer.clear()
+
 class Bomb(Object):
     def __init__(self, fast=False, modern=False, **kwargs):
         super(self.__class__, self).__init__(**kwargs)
@@ -441,6 +1249,9 @@ class Bomb(Object):
             self.surface = self.surfaces[self.frames[self.state][0]]
         self.breakable = True
 
+        self.interp = Interp(limit=None) # kicked by a remote player
+        self.predicted = None # when we placed it, until the server agrees
+
         self.life = 2.5
         if fast:
             self.life /= 2.0
@@ -453,13 +1264,18 @@ class Bomb(Object):
         else:
             self.radius = 1
 
+    @trace.traced('Bomb.explode')
     def explode(self):
         
+        if self.predicted:
+            return False # not the server's (yet), it mustn't break anything
+        
         self.snap()
         self.vel = Vector2(0.0, 0.0)
-        self.attached = False
+        world = self.game.world
+        world.detach(self)
             
-        self.game.world.attach(Splode(game=self.game, pos=self.pos, sz=TILE_SZ_T, owner=self.owner))
+        world.ignite(self.pos)
         
         offset = [
             Vector2(TILE_SZ, 0.0),
@@ -468,13 +1284,6 @@ class Bomb(Object):
             Vector2(0.0, TILE_SZ)
         ]
         
-        def cb(x):
-            if x.attached and x.breakable:
-                x.explode()
-            return x.breakable
-            
-        fail_cb = lambda x: x.solid and not x.breakable
-        
         if self.owner:
             owner = self.owner()
             radius = owner.get_radius() if owner else self.radius
@@ -484,10 +1293,21 @@ class Bomb(Object):
         for d in range(len(offset)):
             for rad in range(1,radius+1):
                 p = self.pos + (offset[d] * rad)
-                s = Splode(game=self.game, pos=p, sz=TILE_SZ_T, owner=self.owner)
-                o = self.game.world.overwrite(s, cb=cb, fail_cb=fail_cb, keep=net.client)
-                if o:
+                i, j = world.cell(p)
+                tile = world.tile(i, j)
+                if tile == Tile.Solid:
+                    break
+                hits = world.overlapping((p.x, p.y, TILE_SZ, TILE_SZ))
+                if filter(lambda x: not x.breakable, hits):
                     break
+                if tile == Tile.Breakable:
+                    world.break_wall(i, j)
+                for x in hits:
+                    if x.attached:
+                        x.explode()
+                world.ignite(p)
+                if tile or hits:
+                    break # the flames stop at what they broke
         
         return True
     
@@ -498,17 +1318,30 @@ class Bomb(Object):
             float((self.pos.y+TILE_SZ/2.0)//TILE_SZ*TILE_SZ)
         )
         
+    def stop(self):
+        self.vel = Vector2(0.0,0.0)
+        self.interp.clear()
+        self.snap()
+        
     def logic(self, t):
 
-        old_pos = copy(self.pos)
-        super(self.__class__,self).logic(t)
-        
-        cols = self.colliders()
-        
-        if len(cols):
-            self.vel = Vector2(0.0,0.0)
-            self.pos = copy(old_pos)
-            self.snap()
+        if len(self.interp):
+            pos, self.vel = self.interp.sample(time.time() - INTERP_DELAY)
+            step = pos - self.pos
+        else:
+            step = self.vel * t
+        
+        if step:
+            # resting bombs cost nothing, kicked ones stop at what they hit
+            self.pos, contacts = self.game.world.sweep(self, step)
+            if contacts:
+                self.stop()
+            self.check_bounds()
+        
+        if self.predicted and time.time() - self.predicted > PLANT_TIMEOUT:
+            # the server never placed it, take it back
+            self.game.world.detach(self)
+            return
         
         self.life -= t
         if self.life <= 0.0:
@@ -551,16 +1384,20 @@ class Guy(Object):
         self.on_kill = Signal()
         self.on_stop_curse = Signal()
         self.on_trigger = Signal()
+        self.on_kick = Signal()
+        self.on_input = Signal()
 
         if net.online:
             net.on_packet.connect(self.event, "guy" + str(self.profile.num))
             if net.server:
                 self.on_give.connect(self.send_give)
                 self.on_kill.connect(self.send_kill)
+                self.on_move.connect(self.send_move)
+                self.on_kick.connect(self.send_kick)
             if not self.dummy:
                 self.on_trigger.connect(self.send_trigger)
                 self.on_multiplant.connect(self.send_multiplant)
-                self.on_move.connect(self.send_move)
+                self.on_input.connect(self.send_input)
                 self.on_plant.connect(self.send_plant)
 
         self.char = [
@@ -568,32 +1405,17 @@ class Guy(Object):
             'fetusmaximus',
             'sheepy',
             'army'
-        ][self.profile.num]
+        ][self.profile.num % 4]
         
         fn = './data/gfx/bomber-%s.png' % self.char
         if not net.server:
-            self.surfaces = tileset(fn)
-            self.surfaces += tileset(fn, hflip=True)[6:13]
+            self.surfaces = tileset(fn, rle=False)
+            self.surfaces += tileset(fn, hflip=True, rle=False)[6:13]
 
             if self.profile.color != (255,255,255):
-                for s in self.surfaces:
-                    s.lock()
-                    for y in xrange(s.get_height()):
-                        for x in xrange(s.get_width()):
-                            player_col = pygame.Color(
-                                self.profile.color[0],
-                                self.profile.color[1],
-                                self.profile.color[2],
-                                255
-                            )
-                            pxc = copy(s.get_at((x,y)))
-                            if pxc != pygame.Color(255,0,255):
-                                mix = 0.5
-                                pxc.r = int((mix*(player_col.r/255.0) + (1.0-mix)*(pxc.r/255.0)) * 255)
-                                pxc.g = int((mix*(player_col.g/255.0) + (1.0-mix)*(pxc.g/255.0)) * 255)
-                                pxc.b = int((mix*(player_col.b/255.0) + (1.0-mix)*(pxc.b/255.0)) * 255)
-                                s.set_at((x,y), pxc)
-                    s.unlock()
+                self.tint(self.profile.color)
+            for s in self.surfaces:
+                s.set_colorkey(TRANS, pygame.RLEACCEL) # tinted, RLE from now
         
         self.frames = {
             "down": [0,1,2,1,3,4,5,4],
@@ -627,76 +1449,117 @@ class Guy(Object):
         self.old_pos = self.pos
         
         self.last_sent_vel = Vector2()
+        self.last_sent_time = 0.0
+        self.interp = Interp()
+
+        # client side prediction: inputs not yet acknowledged by the server
+        self.input_seq = 0
+        self.last_input = 0 # last input processed (server)
+        self.input_time = 0.0 # seconds its inputs may still move (server)
+        self.last_sent_input = 0
+        self.sent_inputs = deque(maxlen=INPUT_REDUNDANCY) # (bits, ms)
+        self.pending = deque()
+        self.acked_pos = None # predicted position after the last acked input
+
+    @trace.traced('Guy.tint')
+    def tint(self, color, mix=0.5):
+        """Blends our frames halfway to the player's color."""
+        # a whole frame at a time, an arena has a lot of guys
+        player_col = numpy.array(color) / 255.0
+        for s in self.surfaces:
+            px = pygame.surfarray.array3d(s)
+            opaque = (px != TRANS).any(axis=2)
+            tinted = (mix*player_col + (1.0-mix)*(px/255.0)) * 255
+            px[opaque] = tinted[opaque].astype(int)
+            pygame.surfarray.blit_array(s, px)
 
     def event(self, ev, data, peer):
-        if ev == Net.Event.MOVE:
+        if ev == Net.Event.INPUT:
             if net.server:
-                if peer.player_id == self.profile.num:
-                    (
-                        self.pos.x, self.pos.y,
-                        self.vel.x, self.vel.y
-                    ) = struct.unpack('ffff',data)
-                    net.broadcast(Net.Event.MOVE,
-                        struct.pack('=B', peer.player_id) + data, 0)
-            elif self.dummy:
-                (profile_num,) = struct.unpack('B',data[:1])
+                if peer.player_id == self.profile.num and not self.frozen:
+                    values = Msg.INPUT.read(data)
+                    (seed, seq), inputs = values[:2], values[2:]
+                    if seed != net.seed & 0xFF:
+                        return # sent during the previous round
+                    # oldest first, skipping what already arrived, and
+                    # no faster than the server's own clock allows
+                    for n in reversed(xrange(INPUT_REDUNDANCY)):
+                        if seq - n <= self.last_input:
+                            continue
+                        bits, ms = inputs[2*n:2*n+2]
+                        t = min(ms * 0.001, MAX_INPUT_DT, self.input_time)
+                        self.input_time -= t
+                        self.move(input_direction(bits), t)
+                        self.last_input = seq - n
+        elif ev == Net.Event.MOVE:
+            if net.client:
+                (profile_num, seq, px, py, vx, vy) = Msg.MOVE.read(data)
                 if profile_num == self.profile.num:
-                    (
-                        self.pos.x, self.pos.y,
-                        self.vel.x, self.vel.y
-                    ) = struct.unpack('ffff',data[1:])
-                    self.set_direction(self.vel)
+                    if self.dummy:
+                        self.interp.push(time.time(), Vector2(px, py), Vector2(vx, vy))
+                    else:
+                        self.reconcile(seq, Vector2(px, py))
         elif ev == Net.Event.PLANT:
             if net.server:
                 if peer.player_id == self.profile.num:
                     pos = Vector2()
-                    (pos.x,pos.y) = struct.unpack('ff',data[:8])
-                    self.plant(Vector2(), True, True, pos)
-                    net.broadcast(Net.Event.PLANT,
-                        struct.pack('B',peer.player_id) + data,
-                        enet.PACKET_FLAG_RELIABLE)
+                    (pos.x,pos.y) = Msg.PLANT.read(data)
+                    if self.plant(Vector2(), True, True, pos):
+                        net.broadcast(Msg.PLANTED, peer.player_id, pos.x, pos.y)
             else:
                 pos = Vector2()
-                (profile_num,pos.x,pos.y) = struct.unpack('=Bff',data[:9])
+                (profile_num,pos.x,pos.y) = Msg.PLANTED.read(data)
                 if profile_num == self.profile.num:
-                    self.plant(Vector2(), True, True, pos)
+                    # ours was already placed when predicted
+                    if self.dummy or not self.confirm(self.plant_pos(pos)):
+                        b = self.plant(Vector2(), True, True, pos)
+                        if b:
+                            b.predicted = None
         elif ev == Net.Event.GIVE:
             if net.client:
-                (profile_num,item,curse,) = struct.unpack('=BBB',data[:3])
+                (profile_num,item,curse,) = Msg.GIVE.read(data)
                 if profile_num == self.profile.num:
                     self.give(item, curse, True, True)
         elif ev == Net.Event.KILL:
             if net.client:
-                (profile_num,) = struct.unpack('B',data[:1])
+                (profile_num,) = Msg.KILL.read(data)
                 if profile_num == self.profile.num:
                     self.kill()
         elif ev == Net.Event.TRIGGER:
             if net.server:
                 if peer.player_id == self.profile.num:
                     self.trigger(True, True)
-                    net.broadcast(Net.Event.TRIGGER,
-                        struct.pack('B',peer.player_id) + data,
-                        enet.PACKET_FLAG_RELIABLE)
+                    net.broadcast(Msg.TRIGGERED, peer.player_id)
             else:
-                (profile_num,) = struct.unpack('B',data[:1])
-                if profile_num == self.profile.num:
+                (profile_num,) = Msg.TRIGGERED.read(data)
+                if profile_num == self.profile.num and self.dummy:
                     self.trigger(True, True)
         elif ev == Net.Event.MULTIPLANT:
             if net.server:
                 if peer.player_id == self.profile.num:
-                    pos = Vector2()
-                    px,py = 0.0,0.0
-                    (px,py,direc) = struct.unpack('=ffB', data[:9])
+                    (px,py,direc) = Msg.MULTIPLANT.read(data)
                     pos = Vector2(px,py)
-                    self.multiplant(True, True, pos, direc)
-                    net.broadcast(Net.Event.MULTIPLANT,
-                        struct.pack('B',peer.player_id) + data,
-                        enet.PACKET_FLAG_RELIABLE)
+                    if self.multiplant(True, True, pos, direc):
+                        net.broadcast(Msg.MULTIPLANTED, peer.player_id, px, py, direc)
             else:
                 pos = Vector2()
-                (profile_num,pos.x,pos.y,direc) = struct.unpack('=BffB',data[:10])
+                (profile_num,pos.x,pos.y,direc) = Msg.MULTIPLANTED.read(data)
                 if profile_num == self.profile.num:
-                    self.multiplant(True, True, pos, direc)
+                    if self.dummy:
+                        self.multiplant(True, True, pos, direc)
+                    else:
+                        # ours were placed when predicted, as far as they go
+                        d = self.dir_vec(direc) * TILE_SZ
+                        ofs = copy(d)
+                        while self.confirm(self.plant_pos(pos, ofs)):
+                            ofs += d
+        elif ev == Net.Event.KICK:
+            if net.client and self.dummy:
+                (profile_num,px,py,vx,vy) = Msg.KICK.read(data)
+                if profile_num == self.profile.num:
+                    b = self.game.world.bomb_at(Vector2(px,py))
+                    if b:
+                        b.interp.push(time.time(), Vector2(px,py), Vector2(vx,vy))
 
 
     def set_direction(self, vel):
@@ -712,48 +1575,72 @@ class Guy(Object):
     def send_trigger(self):
         if self.dummy:
             return
-        net.broadcast(Net.Event.TRIGGER, "", enet.PACKET_FLAG_RELIABLE)
+        net.broadcast(Msg.TRIGGER)
 
     def send_multiplant(self, pos, direc):
         if self.dummy:
             return
-        net.broadcast(Net.Event.MULTIPLANT,
-            struct.pack('=ffB',pos.x,pos.y,direc),
-            enet.PACKET_FLAG_RELIABLE)
+        net.broadcast(Msg.MULTIPLANT, pos.x, pos.y, direc)
     
+    def send_input(self, seq, bits, ms):
+        # resent with the next few, in case this packet is lost
+        self.sent_inputs.appendleft((bits, ms))
+        inputs = list(self.sent_inputs)
+        inputs += [(0, 0)] * (INPUT_REDUNDANCY - len(inputs))
+        net.broadcast(Msg.INPUT, net.seed & 0xFF, seq,
+            *sum(inputs, ()))
+
     def send_move(self):
-        if not self.dummy:
-            if self.vel or self.last_sent_vel: # moving or just stopped
-                data = struct.pack(
-                    'ffff',
-                    self.pos.x, self.pos.y, self.vel.x, self.vel.y
-                )
-                net.broadcast(Net.Event.MOVE, data, 0)
-                self.last_sent_vel = self.vel
+        now = time.time()
+        # authoritative state: sent on every change of velocity (started,
+        # stopped, turned), and at MOVE_RATE while moving or acknowledging
+        # inputs, so remote players can dead reckon
+        if self.vel != self.last_sent_vel or \
+            ((self.vel or self.last_input != self.last_sent_input) and \
+                now - self.last_sent_time >= 1.0 / MOVE_RATE):
+            net.broadcast(Msg.MOVE, self.profile.num, self.last_input,
+                self.pos.x, self.pos.y, self.vel.x, self.vel.y)
+            self.last_sent_vel = copy(self.vel)
+            self.last_sent_input = self.last_input
+            self.last_sent_time = now
+
+    def send_kick(self, bomb, pos):
+        net.broadcast(Msg.KICK, self.profile.num,
+            pos.x, pos.y, bomb.vel.x, bomb.vel.y)
     
     def send_plant(self, pos):
         if self.dummy:
             return
-        net.broadcast(
-            Net.Event.PLANT,
-            struct.pack('ff',pos.x,pos.y),
-            enet.PACKET_FLAG_RELIABLE)
+        net.broadcast(Msg.PLANT, pos.x, pos.y)
 
     def send_give(self, item, curse):
-        net.broadcast(Net.Event.GIVE,
-            struct.pack('BBB',self.profile.num, item, curse),
-            enet.PACKET_FLAG_RELIABLE)
+        net.broadcast(Msg.GIVE, self.profile.num, item, curse)
         
     def send_kill(self):
-        net.broadcast(Net.Event.KILL,
-            struct.pack('B',self.profile.num),
-            enet.PACKET_FLAG_RELIABLE)
+        net.broadcast(Msg.KILL, self.profile.num)
         
     def get_radius(self):
         if self.curse == Curse.SmallBlast:
             return 1
         return self.radius
         
+    def rewind(self):
+        """
+        How far back the flames this guy is judged against are.  A remote
+        player's bombs go off for them half a round trip after they do on
+        the server (flames aren't interpolated, they follow the fuses), and
+        their moves arrive half a round trip late, so they are checked
+        against the flames of a round trip ago (up to MAX_REWIND).
+        """
+        peer = self.profile.peer
+        if not net.server or not peer or not peer.peer:
+            return 0.0
+        try:
+            rtt = peer.peer.roundTripTime * 0.001
+        except (AttributeError, IOError):
+            return 0.0
+        return min(rtt, MAX_REWIND)
+    
     def kill(self):
         self.on_kill()
         self.frozen = True
@@ -772,11 +1659,11 @@ class Guy(Object):
             self.stop_curse()
     
     def random_curse(self):
-        return random.randint(1,Curse.Max-1)
+        return self.game.world.curse_rng.randint(1,Curse.Max-1)
     
     def do_curse(self, curse=0):
         self.stop_curse()
-        self.curse  = random.randint(1,Curse.Max-1) if not curse else curse
+        self.curse  = self.random_curse() if not curse else curse
         self.curse_time = 10.0
         if self.curse == Curse.Slow:
             self.speed = Guy.SPEED / 2.0
@@ -787,7 +1674,7 @@ class Guy(Object):
                 x.attached and isinstance(x, Guy) and x != self, self.game.world.objects
             )
             if len(players_on_map) >= 1:
-                random_player = random.choice(players_on_map)
+                random_player = self.game.world.curse_rng.choice(players_on_map)
                 self.pos, random_player.pos = random_player.pos, self.pos
                 self.old_pos, random_player.old_pos = random_player.old_pos, self.old_pos
             self.stop_curse() # no persist
@@ -822,20 +1709,29 @@ class Guy(Object):
         elif item == Item.Remote:
             self.remote = True
     
+    def confirm(self, pos):
+        """The server placed our predicted bomb at pos too."""
+        b = self.game.world.bomb_at(pos)
+        if b and b.predicted and b.owner and b.owner() is self:
+            b.predicted = None
+            return True
+        return False
+    
     def get_my_bombs(self):
-        return filter(lambda x:
-            x.attached and isinstance(x, Bomb) and x.owner and x.owner()==self,
-            self.game.world.objects) 
+        # a copy, as detonating one bomb can set off the others
+        return list(self.game.world.bombs_of(self))
+    
+    def plant_pos(self, pos, ofs=Vector2()):
+        # snaps plant position to grid
+        return (pos + self.origin + ofs) // int(TILE_SZ) * int(TILE_SZ)
     
     def plant(self, ofs = Vector2(), mute=False, force=False, pos=None):
         
         if self.curse == Curse.NoPlant:
             return None
         
-        my_bombs = self.get_my_bombs()
-
         # when player runs out of bombs, disallow planting
-        if len(my_bombs) >= self.bombs:
+        if len(self.game.world.bombs_of(self)) >= self.bombs:
             return None
 
         pos = pos if pos else self.pos
@@ -844,20 +1740,18 @@ class Guy(Object):
         if not mute:
             self.on_plant(pos)
         
-        # if not isinstance(pos, Vector2):
-        pos = (pos + self.origin + ofs) // int(TILE_SZ) * int(TILE_SZ)
-        # else:
-        #     pos = (pos + self.origin + ofs) // int(TILE_SZ) * int(TILE_SZ)
+        pos = self.plant_pos(pos, ofs)
         
         b = Bomb(
             fast=(self.curse==Curse.FastBomb),modern=self.remote,
             game=self.game, pos=pos, sz=TILE_SZ_T, solid=True, owner=self)
 
-        if net.client and not force:
-            return self.game.world.can_place(b)
-
+        # placed right away on clients too (predicted), the server's
+        # echo is ignored if it matches
         r = self.game.world.place(b)
         if r:
+            if net.client and not self.dummy:
+                b.predicted = time.time()
             #self.last_bomb = weakref.ref(b)
             self.game.play(self.game.place_snd)
             return b
@@ -904,8 +1798,6 @@ class Guy(Object):
         
         if not mute:
             self.on_multiplant(pos, direc)
-        if net.client and not force:
-            return
         
         if self.curse == Curse.NoPlant:
             return None
@@ -920,8 +1812,6 @@ class Guy(Object):
     def trigger(self, mute=False, force=False):
         if not mute:
             self.on_trigger()
-        if net.client and not force:
-            return
         
         my_bombs = self.get_my_bombs()
 
@@ -931,8 +1821,7 @@ class Guy(Object):
                 self.profile.btn(1, consume=True)
                 # stop a moving bomb
                 self.game.play(self.game.kick_snd)
-                b.vel = Vector2()
-                b.snap()
+                b.stop()
                 stopped_bomb = True
         
         if not stopped_bomb:
@@ -945,14 +1834,14 @@ class Guy(Object):
     
     def logic(self, t):
 
+        if net.server:
+            self.input_time = min(self.input_time + t, INPUT_BANK)
+
         self.curse_logic(t)
         
         self.cols = self.colliders()
-        self.solid_cols = filter(lambda x: x.solid, self.cols)
-        self.snapped_cols = []
         
         v = Vector2(0.0, 0.0)
-        self.vel_intent = Vector2(0.0, 0.0)
         if not self.dummy:
             if not self.frozen:
                 if self.profile.btn('left'):
@@ -972,31 +1861,28 @@ class Guy(Object):
                     if v.magnitude() <= EPSILON:
                         v = copy(self.last_vel_intent)
                 
-                if v.magnitude() >= EPSILON:
-                    
-                    v.normalize()
-                    v *= self.speed
-                    
-                    # collision
-                    self.old_pos = copy(self.pos)
-                    self.vel = v
-                    self.vel_intent = copy(v)
-                    self.last_vel_intent = copy(v)
-                    
-                    if abs(self.vel) >= EPSILON:
-                        self.pos += self.vel * t
-                        if self.snap():
-                            self.pos.x += self.vel.x * t
-                            if self.snap():
-                                self.pos.y += self.vel.y * t
-                                if self.snap():
-                                    self.vel = Vector2(0.0, 0.0)
-                    
-            
-            self.vel = v
+                direc = Vector2(sgn(v.x), sgn(v.y))
+                if direc or self.vel:
+                    t = min(t, MAX_INPUT_DT) # as the server will
+                    if net.client:
+                        # sent as whole milliseconds, predict with the same
+                        ms = int(round(t * 1000.0))
+                        t = ms * 0.001
+                    self.move(direc, t)
+                    if net.client:
+                        # predicted now, the server acknowledges it later
+                        self.input_seq += 1
+                        self.pending.append((self.input_seq, direc, t, copy(self.pos)))
+                        self.on_input(self.input_seq, input_bits(direc), ms)
+            else:
+                self.vel = v
+        else:
+            state = self.interp.sample(time.time() - INTERP_DELAY)
+            if state:
+                self.pos, self.vel = state
+                self.set_direction(self.vel)
 
-        bad_objs = filter(lambda x: x.hurt, self.cols)
-        if bad_objs:
+        if self.game.world.burning(self.box(), self.rewind()):
             self.frozen = True
             if not net.client:
                 self.kill()
@@ -1006,15 +1892,6 @@ class Guy(Object):
                 self.give(col.item_id)
                 col.attached = False
 
-        for col in self.snapped_cols:
-            if not col.attached:
-                continue
-            if isinstance(col, Bomb):
-                if self.kick and not self.remote:
-                    if self.vel_intent.magnitude() >= EPSILON:
-                        col.vel = copy(self.vel_intent) * 2.0
-                        self.game.play(self.game.kick_snd)
-
         self.cols = self.colliders()
 
         if self.pos.x < -self.sz.x or self.pos.x >= self.game.world.sz.x:
@@ -1068,18 +1945,58 @@ class Guy(Object):
 
         self.on_move()
         
-    def snap(self):
-        objs = self.game.world.objects
-        objs = filter(lambda x: x != self and x.solid and x.attached, objs)
-        objs = filter(lambda x: x not in self.solid_cols, objs)
-        objs = map(lambda x: x.mask(), objs)
-        if -1 != self.mask().collidelist(objs):
-            self.snapped_cols += self.colliders()
-            self.snapped_cols = list(set(self.snapped_cols))
-            self.pos = copy(self.old_pos) # snap
-            return True
-        return False
+    def move(self, direc, t, replay=False):
+        """
+        Moves in direction direc at the current speed for t seconds,
+        sliding along walls, and kicks bombs we run into.  A replay (during
+        reconciliation) has no side effects besides moving.
+        """
+        self.snapped_cols = []
+        v = copy(direc)
+        self.vel_intent = Vector2(0.0, 0.0)
+        
+        if v.magnitude() >= EPSILON:
+            v.normalize()
+            v *= self.speed
+            
+            # collision
+            self.old_pos = copy(self.pos)
+            self.vel_intent = copy(v)
+            self.last_vel_intent = copy(v)
+            
+            self.pos, self.snapped_cols = self.game.world.sweep(self, v * t)
+        
+        self.vel = v
+        
+        if replay:
+            return
+        
+        for col in self.snapped_cols:
+            if isinstance(col, Bomb) and col.attached:
+                if self.kick and not self.remote:
+                    if self.vel_intent.magnitude() >= EPSILON:
+                        col.vel = copy(self.vel_intent) * 2.0
+                        self.on_kick(col, copy(col.pos))
+                        self.game.play(self.game.kick_snd)
 
+    def reconcile(self, seq, pos):
+        """
+        Checks the server's position after input seq against what we
+        predicted.  On a misprediction, rewinds to the server's position and
+        replays the inputs it hasn't processed yet.
+        """
+        predicted = self.acked_pos
+        while self.pending and self.pending[0][0] <= seq:
+            predicted = self.pending.popleft()[3]
+        self.acked_pos = copy(pos)
+        if predicted is not None and abs(predicted - pos) < 0.5:
+            return
+        self.pos = pos
+        for i in xrange(len(self.pending)):
+            _, direc, t, _ = self.pending[i]
+            self.move(direc, t, replay=True)
+            self.pending[i] = self.pending[i][:3] + (copy(self.pos),)
+    
     def mask(self):
         return pygame.Rect(
             self.pos.x+self.sz.x/4.0, 
@@ -1088,17 +2005,68 @@ class Guy(Object):
             int(round((self.sz.y/2.0)))
         )
 
+class Tile:
+    Empty = 0
+    Solid = 1
+    Breakable = 2
+
+def generate_map(w, h, spawns, rng, density=0.8):
+    """
+    Generates a w x h tile array: solid border and pillars, with breakable
+    walls sprinkled everywhere except around the spawn points.
+    """
+    j, i = numpy.mgrid[0:h, 0:w]
+    solid = (i == 0) | (j == 0) | (i == w-1) | (j == h-1)
+    solid |= (i % 2 == 0) & (j % 2 == 0)
+    
+    # don't sprinkle inside/around spawning area
+    spawn_area = numpy.zeros((h, w), dtype=bool)
+    for si, sj in spawns:
+        spawn_area |= (i == si) & (abs(j - sj) <= 2)
+        spawn_area |= (j == sj) & (abs(i - si) <= 2)
+    
+    tiles = numpy.zeros((h, w), dtype=numpy.uint8)
+    tiles[(rng.random_sample((h, w)) < density) & ~spawn_area] = Tile.Breakable
+    tiles[solid] = Tile.Solid
+    return tiles
+
+def load_map(fn):
+    with open(fn, 'rb') as f:
+        buf = f.read()
+    magic, version, w, h = MAP_HEADER.unpack_from(buf)
+    if magic != MAP_MAGIC or version != MAP_VERSION:
+        raise ValueError("%s: not a map file" % fn)
+    tiles = numpy.frombuffer(buf, dtype=numpy.uint8, count=w*h,
+        offset=MAP_HEADER.size)
+    return tiles.reshape((h, w))
+
+def map_crc():
+    """CRC-32 of the --map layout, 0 for generated maps."""
+    fn = option('map')
+    if not fn:
+        return 0
+    return zlib.crc32(load_map(fn).tostring()) & 0xffffffff
+
+def save_map(fn, tiles):
+    h, w = tiles.shape
+    with open(fn, 'wb') as f:
+        f.write(MAP_HEADER.pack(MAP_MAGIC, MAP_VERSION, w, h))
+        f.write(numpy.ascontiguousarray(tiles, dtype=numpy.uint8).tostring())
+
 class World:
-    def __init__(self, game):
+    @trace.traced('World.__init__')
+    def __init__(self, game, seed=None):
         self.sz = Vector2(
             SCREEN_SZ[0], SCREEN_SZ[1]
         )
         self.ofs = Vector2()
         
-        line = []
         self.game = game
         self.game.world = self
         self.objects = []
+        self.bombs = {} # owner Guy -> set of its attached bombs
+        self.movers = [] # solid objects (bombs), walls are in tiles
+        self.guys = [] # not solid, but they stop kicked bombs
         self.wall = load_image('data/gfx/concrete-gray-solid.png')
         self.bwall = load_image('data/gfx/concrete-gray-breakable.png')
         self.bomb = tileset('data/gfx/bomb-toon.png')
@@ -1118,8 +2086,13 @@ class World:
         self.h = int(SCREEN_SZ[1] / TILE_SZ - 1)
         if self.h % 2 == 0:
             self.h -= 1
-        w = self.w
-        h = self.h
+        if len(game.profiles) > 4:
+            # an arena: as much room per guy as four get on one screen,
+            # the view follows our guy around
+            scale = math.sqrt(len(game.profiles) / 4.0)
+            self.w = int(self.w * scale) | 1
+            self.h = int(self.h * scale) | 1
+            self.ofs = Vector2()
 
         self.splode = tileset('data/gfx/explosion-toon.png')
         
@@ -1135,122 +2108,314 @@ class World:
         self.items, self.items_p = zip(*self.items)
         s = sum(self.items_p)
         self.items_p = map(lambda x: x / s, self.items_p)
-        
-        if net.local:
-            random.seed()
+        self.item_table = AliasTable(self.items_p)
+        
+        if seed is None:
+            seed = random.getrandbits(64) if net.local else net.seed
+        self.rng = Rng(seed)
+        self.drop_rng = self.rng.split('drops')
+        self.curse_rng = self.rng.split('curses')
+
+        # the walls: a Tile per cell, emptied as breakable ones are blown up
+        fn = option('map')
+        if fn:
+            self.tiles = load_map(fn).copy()
+            self.h, self.w = self.tiles.shape
         else:
-            random.seed(net.seed)
-        
-        for j in range(0, self.h):
-            for i in range(0, self.w):
-                if i==0 or j==0 or i==w-1 or j==h-1:
-                    obj = Wall(game=game, pos=(i*TILE_SZ*1.0, j*TILE_SZ*1.0), sz=TILE_SZ_T, surface=self.wall, solid=True)
-                    self.attach(obj)
-                elif i%2==0 and j%2==0:
-                    obj = Wall(game=game, pos=(i*TILE_SZ*1.0, j*TILE_SZ*1.0), sz=TILE_SZ_T, surface=self.wall, solid=True)
-                    self.attach(obj)
-                elif random.random() < 0.8:
-                    
-                    # don't sprinkle inside/around spawning area
-                    if i==1 and 1<=j<=3 or j==1 and 1<=i<=3:
-                        continue
-                    if i==w-2 and 1<=j<=3 or j==1 and w-4<=i<=w-2:
-                        continue
-                    if i==w-2 and h-4<=j<=h-2 or j==h-2 and w-4<=i<=w-2:
-                        continue
-                    if i==1 and h-4<=j<=h-2 or j==h-2 and 1<=i<=3:
-                        continue
-                    
-                    obj = Wall(game=game, pos=(i*TILE_SZ*1.0, j*TILE_SZ*1.0), sz=TILE_SZ_T,surface=self.bwall, solid=True, breakable=True)
-                    self.attach(obj)
-        
+            self.tiles = generate_map(self.w, self.h, self.spawns(),
+                self.rng.split('map'))
+            if option('save-map'):
+                self.save(option('save-map'))
+        self.sz.x = max(self.sz.x, self.w*TILE_SZ)
+        self.sz.y = max(self.sz.y, self.h*TILE_SZ)
+        
+        # seconds each tile has been burning, inf when it isn't
+        self.fire = numpy.empty((self.h, self.w))
+        self.fire.fill(numpy.inf)
+        self.clock = 0.0 # seconds played this round
+        # (clock, tiles with flames that hurt) as of each tick, MAX_REWIND back
+        self.flames = deque()
+        
+        self.tile_surfaces = {
+            Tile.Solid: self.wall,
+            Tile.Breakable: self.bwall
+        }
+
         self.next_level = False
         
+    def spawns(self):
+        """
+        Spawn points in tile coordinates, one per corner.  Arenas get one per
+        guy, each further one on the open tile farthest from the others.
+        """
+        points = [
+            (1, 1),
+            (self.w-2, self.h-2),
+            (1, self.h-2),
+            (self.w-2, 1)
+        ]
+        # squared distance from each open tile between the pillars to
+        # the nearest spawn so far
+        j, i = numpy.mgrid[1:self.h-1:2, 1:self.w-1:2]
+        i, j = i.ravel(), j.ravel()
+        dist = numpy.empty(i.shape)
+        dist.fill(numpy.inf)
+        for si, sj in points:
+            dist = numpy.minimum(dist, (i - si)**2 + (j - sj)**2)
+        while len(points) < len(self.game.profiles):
+            n = numpy.argmax(dist)
+            points += [(int(i[n]), int(j[n]))]
+            dist = numpy.minimum(dist, (i - i[n])**2 + (j - j[n])**2)
+        return tuple(points)
+
+    def save(self, fn):
+        save_map(fn, self.tiles)
+        
+    def tile(self, i, j):
+        """The Tile at column i, row j, Empty off the map."""
+        if 0 <= i < self.w and 0 <= j < self.h:
+            return self.tiles.item(j, i)
+        return Tile.Empty
+
+    def break_wall(self, i, j):
+        """Blows up the breakable wall at column i, row j."""
+        pos = Vector2(i*TILE_SZ*1.0, j*TILE_SZ*1.0)
+        if not net.client:
+            item = self.random_item(game=self.game, pos=pos, sz=TILE_SZ_T, solid=False)
+            if item:
+                self.attach(item)
+            if net.online:
+                net.broadcast(Msg.SPAWN,
+                    item.item_id if item else Item.NoItem, pos.x, pos.y)
+        self.tiles[j, i] = Tile.Empty
+
     def clear(self, pos):
+        i, j = self.cell(pos)
+        if self.tile(i, j):
+            self.tiles[j, i] = Tile.Empty
         px, py = int(pos.x), int(pos.y)
         for obj in self.objects:
             ox, oy = int(obj.pos.x), int(obj.pos.y)
             if ox == px and oy == py:
-                obj.attached = False
+                self.detach(obj)
     
     def attach(self, obj):
         if not obj.attached:
             self.objects += [obj]
             obj.attached = True
+            if isinstance(obj, Bomb) and obj.owner and obj.owner():
+                self.bombs.setdefault(obj.owner(), set()).add(obj)
+            if obj.solid:
+                self.movers += [obj]
+            elif isinstance(obj, Guy):
+                self.guys += [obj]
+    
+    def detach(self, obj):
+        obj.attached = False
+        if isinstance(obj, Bomb) and obj.owner:
+            self.bombs.get(obj.owner(), set()).discard(obj)
+        if obj in self.movers:
+            self.movers.remove(obj)
+        elif obj in self.guys:
+            self.guys.remove(obj)
+    
+    @staticmethod
+    def cell(pos):
+        return (int(pos.x // float(TILE_SZ)), int(pos.y // float(TILE_SZ)))
+    
+    def walls_in(self, box):
+        """(column, row) of the walls overlapping box (x, y, w, h)."""
+        x, y, w, h = box
+        cells = []
+        for i in xrange(int(x // float(TILE_SZ)), int(math.ceil((x + w) / float(TILE_SZ)))):
+            for j in xrange(int(y // float(TILE_SZ)), int(math.ceil((y + h) / float(TILE_SZ)))):
+                if self.tile(i, j):
+                    cells += [(i, j)]
+        return cells
+    
+    def overlapping(self, box, obj=None):
+        """Solid objects overlapping box (x, y, w, h), besides obj."""
+        x, y, w, h = box
+        objs = []
+        for o in self.movers:
+            if o is not obj and o.attached:
+                ox, oy, ow, oh = o.box()
+                if ox < x + w and x < ox + ow and oy < y + h and y < oy + oh:
+                    objs += [o]
+        return objs
+    
+    def sweep(self, obj, step):
+        """
+        Moves obj's box by step against the walls and other solids, one
+        axis at a time, stopping at the first contact on each axis (so it
+        slides along walls and can't tunnel through them).  Guys walk
+        through each other but solids (kicked bombs) stop at them.  Movers
+        it already overlaps are ignored, so a guy can walk off the bomb he
+        just planted, walls never are.  Returns the new position and what
+        was hit: objects, and the (column, row) of walls.
+        """
+        box = list(obj.box())
+        ignore = self.overlapping(box, obj)
+        movers = self.movers + self.guys if obj.solid else self.movers
+        movers = [o for o in movers
+            if o is not obj and o.attached and o not in ignore]
+        contacts = []
+        d = [0.0, 0.0]
+        for axis in AXES:
+            d[axis], hits = self.sweep_axis(axis, box, step[axis], movers)
+            box[axis] += d[axis]
+            contacts += hits
+        return obj.pos + Vector2(d[0], d[1]), contacts
+    
+    def sweep_axis(self, axis, box, d, movers):
+        if not d:
+            return 0.0, []
+        sign = sgn(d)
+        other = 1 - axis
+        lo, hi = box[other], box[other] + box[other+2] # across the motion
+        edge = box[axis] + box[axis+2] if sign > 0 else box[axis] # leading
+        end = edge + d
+        hits = []
+        
+        # walls, a row (or column) of tiles at a time in the direction of travel
+        if sign > 0:
+            lines = xrange(int(edge // float(TILE_SZ)), int(math.ceil(end / float(TILE_SZ))))
+        else:
+            lines = xrange(int(math.ceil(edge / float(TILE_SZ))) - 1,
+                int(end // float(TILE_SZ)) - 1, -1)
+        across = xrange(int(lo // float(TILE_SZ)), int(math.ceil(hi / float(TILE_SZ))))
+        for n in lines:
+            for m in across:
+                cell = (n, m) if axis == 0 else (m, n)
+                if self.tile(*cell):
+                    hits += [cell]
+            if hits:
+                # one we're already inside stops us where we are
+                d = (n if sign > 0 else n + 1) * TILE_SZ - edge
+                if d * sign < 0:
+                    d = 0.0
+                break
+        
+        # then the few solids that aren't walls
+        for o in movers:
+            b = o.box()
+            if b[other] >= hi or b[other] + b[other+2] <= lo:
+                continue
+            dist = (b[axis] if sign > 0 else b[axis] + b[axis+2]) - edge
+            if 0 <= dist * sign <= d * sign:
+                if dist == d:
+                    hits += [o]
+                else:
+                    d = dist
+                    hits = [o]
+        return d, hits
+    
+    def bombs_of(self, owner):
+        return self.bombs.get(owner, ())
         
     def can_place(self, obj):
         if not obj.attached:
-            objs = self.objects
-            
-            objs = filter(lambda x: x.solid, objs)
-            objs = map(lambda x: x.mask(), objs)
-            
-            if -1 != obj.mask().collidelist(objs):
-                return False
-            
-            return True
+            box = obj.box()
+            return not self.walls_in(box) and not self.overlapping(box, obj)
         return False
         
     def place(self, obj):
-        if not obj.attached:
-            objs = self.objects
-            
-            objs = filter(lambda x: x.solid, objs)
-            objs = map(lambda x: x.mask(), objs)
-            
-            if -1 != obj.mask().collidelist(objs):
-                return False
-            
+        if self.can_place(obj):
             self.attach(obj)
             return True
         return False
 
-    def overwrite(self, obj, cb=None, fail_cb=None, keep=False):
-        if not obj.attached:
-            objs = self.objects
-            
-            objs = filter(lambda x: x.solid, objs)
-            
-            obj_masks = map(lambda x: x.mask(), objs)
-
-            matches = obj.mask().collidelistall(obj_masks)
-            overwritten = []
-            
-            if fail_cb:
-                for r in matches:
-                    if fail_cb(objs[r]):
-                        return fail_cb
-            
-            for r in matches:
-                if not cb or cb(objs[r]):
-                    try:
-                        if not keep:
-                            self.objects.remove(objs[r])
-                        overwritten += [objs[r]]
-                    except ValueError:
-                        pass
-            
-            self.attach(obj)
-            return overwritten
+    def ignite(self, pos):
+        i, j = self.cell(pos)
+        if 0 <= j < self.fire.shape[0] and 0 <= i < self.fire.shape[1]:
+            self.fire[j, i] = 0.0
+    
+    def burning(self, box, rewind=0.0):
+        """
+        Whether flames that still hurt cover any part of box, as they were
+        rewind seconds ago (as of the newest tick at least that old).
+        """
+        x, y, w, h = box
+        cells = (
+            slice(max(int(y // float(TILE_SZ)), 0), int(math.ceil((y + h) / float(TILE_SZ)))),
+            slice(max(int(x // float(TILE_SZ)), 0), int(math.ceil((x + w) / float(TILE_SZ))))
+        )
+        if rewind > 0.0 and self.flames:
+            mask = self.flames[0][1] # as far back as we go
+            for clock, m in self.flames:
+                if clock > self.clock - rewind:
+                    break
+                mask = m
+            return mask[cells].any()
+        return (self.fire[cells] * FIRE_FPS < FIRE_HURT_FRAMES - 0.5).any()
+
+    def bomb_at(self, pos):
+        for obj in self.movers:
+            if obj.attached and isinstance(obj, Bomb):
+                if abs(obj.pos - pos) < TILE_SZ/2.0:
+                    return obj
+        return None
 
     def random_item(self, **kwargs):
-        if random.random() < 0.25:
-            item = numpy.random.choice(self.items, p=self.items_p)
+        if self.drop_rng.random() < 0.25:
+            item = self.items[self.item_table.sample(self.drop_rng)]
             return item(**kwargs)
         return None
         
-    def logic(self):
-        pass
+    def logic(self, t):
+        self.fire += t
+        self.clock += t
+        self.flames.append((self.clock, self.hurting()))
+        # by time, not ticks, whatever the tick rate: keep the newest mask
+        # that is MAX_REWIND old, drop the older ones
+        while len(self.flames) > 1 and \
+            self.flames[1][0] <= self.clock - MAX_REWIND:
+            self.flames.popleft()
+    
+    def hurting(self):
+        return self.fire * FIRE_FPS < FIRE_HURT_FRAMES - 0.5
         
     def render(self, view):
         if net.server:
             return
+        ofs = self.ofs + view # Object.render subtracts it
+        # only what's on screen, with room for sprites taller than a tile
+        x0, y0 = view.x - 2*TILE_SZ, view.y - 2*TILE_SZ
+        x1, y1 = view.x + SCREEN_SZ[0] + TILE_SZ, view.y + SCREEN_SZ[1] + TILE_SZ
+        # walls and flames are drawn in render_order with the objects, as if
+        # each were one more object of depth 1 at its row, flames first
+        i0, j0 = max(int(x0 // TILE_SZ), 0), max(int(y0 // TILE_SZ), 0)
+        i1, j1 = int(x1 // TILE_SZ) + 1, int(y1 // TILE_SZ) + 1
+        cells = numpy.concatenate((
+            numpy.argwhere(self.fire * FIRE_FPS < FIRE_FRAMES - 1),
+            numpy.argwhere(self.tiles[j0:j1, i0:i1]) + (j0, i0)))
+        cells = cells[numpy.argsort(cells[:, 0], kind='mergesort')].tolist()
+        n = 0
+        batch = self.game.screen.batch
         for obj in self.objects:
-            obj.render(self.ofs - view)
+            order = render_order(obj)
+            while n < len(cells) and cells[n][0]*TILE_SZ + 10000 <= order:
+                self.render_tile(batch, cells[n], ofs)
+                n += 1
+            if x0 < obj.pos.x < x1 and y0 < obj.pos.y < y1:
+                obj.render(ofs)
+        for cell in cells[n:]:
+            self.render_tile(batch, cell, ofs)
+        self.game.screen.flush()
+
+    def render_tile(self, batch, cell, ofs):
+        """A wall, or a burning floor tile."""
+        j, i = cell
+        tile = self.tiles[j, i]
+        if tile:
+            surface = self.tile_surfaces[tile]
+        else:
+            surface = self.splode[int(round(self.fire[j, i] * FIRE_FPS))]
+        batch.append((surface, (i*TILE_SZ - ofs.x, j*TILE_SZ - ofs.y)))
 
-def render_order(a,b):
-    v = (a.pos.y + a.depth*10000) - (b.pos.y + b.depth*10000)
-    return int(round(v))
+def render_order(obj):
+    """Sort key: by row, standing objects over what lies on the floor."""
+    return obj.pos.y + obj.depth*10000
 
 class Joystick(object):
     def __init__(self, num, joy=None):
@@ -1311,6 +2476,31 @@ class Joystick(object):
         except IndexError:
             return False
         
+class Input:
+    """Bits of a profile's per-tick input mask."""
+    Left = 1
+    Right = 2
+    Up = 4
+    Down = 8
+    Plant = 16
+    Trigger = 32
+
+INPUT_BITS = {
+    0: Input.Plant, 1: Input.Trigger,
+    'left': Input.Left, 'right': Input.Right,
+    'up': Input.Up, 'down': Input.Down
+}
+
+def input_bits(direc):
+    """Direction bits of a movement direction (signs of x and y)."""
+    return (Input.Left if direc.x < 0 else Input.Right if direc.x > 0 else 0) | \
+        (Input.Up if direc.y < 0 else Input.Down if direc.y > 0 else 0)
+
+def input_direction(bits):
+    return Vector2(
+        (1 if bits & Input.Right else 0) - (1 if bits & Input.Left else 0),
+        (1 if bits & Input.Down else 0) - (1 if bits & Input.Up else 0))
+
 class Profile(object):
     def __init__(self, game, num, joy=None, peer=None):
         self.game = game
@@ -1327,58 +2517,164 @@ class Profile(object):
             self.color = (0xFF, 0xFF, 0x0)
         elif num == 3:
             self.color = (0x00, 0x00, 0xFF)
+        else:
+            # arena players: hues a golden ratio apart never bunch up
+            r, g, b = colorsys.hsv_to_rgb((num * 0.618034) % 1.0, 0.8, 1.0)
+            self.color = (int(r*0xFF), int(g*0xFF), int(b*0xFF))
         self.joy = joy
+        self.input = 0 # Input bits, sampled once per tick
     
-    def btn(self, b, consume=False):
-
+    def poll(self):
+        """Samples the controls into this tick's Input bitmask."""
+        self.input = 0
         if self.dummy:
-            return False
-        
-        r = False
-        
-        if self.joy:
-            if isinstance(b, int):
-                r = self.joy.btn(b, consume=consume)
-                if b == 0:
-                    if not r and ord(' ') in self.game.keys:
-                        r = True
-                        self.game.keys.remove(ord(' '))
-                elif b == 1:
-                    if not r and ord('a') in self.game.keys:
-                        r = True
-                        self.game.keys.remove(ord('a'))
-            elif b == 'left':
-                r = self.joy.axis(AXES[0]) < -0.5 or self.joy.hat(0) or ord('j') in self.game.keys
-            elif b == 'right':
-                r = self.joy.axis(AXES[0]) > 0.5 or self.joy.hat(1) or ord('l') in self.game.keys
-            elif b == 'up':
-                r = self.joy.axis(AXES[1]) < -0.5 or self.joy.hat(2) or ord('i') in self.game.keys
-            elif b == 'down':
-                r = self.joy.axis(AXES[1]) > 0.5 or self.joy.hat(3) or ord('k') in self.game.keys
-            
-            if r:
-                return r
+            return
+        keys = self.game.keys
+        bits = 0
+        joy = self.joy
+        if joy:
+            if joy.axis(AXES[0]) < -0.5 or joy.hat(0):
+                bits |= Input.Left
+            if joy.axis(AXES[0]) > 0.5 or joy.hat(1):
+                bits |= Input.Right
+            if joy.axis(AXES[1]) < -0.5 or joy.hat(2):
+                bits |= Input.Up
+            if joy.axis(AXES[1]) > 0.5 or joy.hat(3):
+                bits |= Input.Down
+            if joy.btn(0):
+                bits |= Input.Plant
+            if joy.btn(1):
+                bits |= Input.Trigger
+            if ord('a') in keys:
+                bits |= Input.Trigger
+                keys.discard(ord('a'))
         
         # temp keys
-        if (not net.online and self.num == 0) or (net.online and not self.dummy):
-        # if self.num == 0 and not self.joy:
-            k = set(map(lambda x: ord(x), ('i','k','j','l',' '))) & set(self.game.keys)
-
-            if b == 0:
-                r = ord(' ') in k
-                if r:
-                    self.game.keys.remove(ord(' '))
-            elif b == 'left':
-                r = ord('j') in k
-            elif b == 'right':
-                r = ord('l') in k
-            elif b == 'up':
-                 r = ord('i') in k
-            elif b == 'down':
-                r = ord('k') in k
-        
+        if joy or (not net.online and self.num == 0) or net.online:
+            if ord('j') in keys:
+                bits |= Input.Left
+            if ord('l') in keys:
+                bits |= Input.Right
+            if ord('i') in keys:
+                bits |= Input.Up
+            if ord('k') in keys:
+                bits |= Input.Down
+            if ord(' ') in keys:
+                bits |= Input.Plant
+                keys.discard(ord(' ')) # one plant per press
+        
+        self.input = bits
+    
+    def btn(self, b, consume=False):
+        bit = INPUT_BITS[b]
+        r = bool(self.input & bit)
+        if consume:
+            self.input &= ~bit
+            if self.joy and isinstance(b, int):
+                self.joy.btn(b, consume=True)
         return r
 
+class Replay(object):
+    """
+    Recording of local matches (--record=FILE): the seed and scores each
+    round starts with and every tick's length and Input bits, enough to
+    play the match again exactly.  Rounds are the keyframes; a 'fresh'
+    one is the first of a GameMode, the rest begin during the tick that
+    ended the round before.
+    """
+    Round = 0
+    Tick = 1
+    
+    def __init__(self, fn, record=False):
+        self.record = record
+        self.records = [] # (Round, fresh, seed, scores), (Tick, t, bits)
+        self.ticks = [] # record index of every tick
+        self.keyframes = [] # (tick, record index, fresh)
+        self.pos = 0 # playback cursor in records
+        if record:
+            self.f = open(fn, 'wb')
+            self.n = None # profiles, known at the first round
+            self.arena = arena_players()
+            return
+        with open(fn, 'rb') as f:
+            buf = f.read()
+        magic, version, self.n, self.arena = REPLAY_HEADER.unpack_from(buf)
+        if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+            raise ValueError("%s: not a replay file" % fn)
+        scores = struct.Struct('<%dH' % self.n)
+        bits = struct.Struct('<%dB' % self.n)
+        ofs = REPLAY_HEADER.size
+        while ofs < len(buf):
+            if ord(buf[ofs]) == Replay.Round:
+                _, fresh, seed = REPLAY_ROUND.unpack_from(buf, ofs)
+                ofs += REPLAY_ROUND.size
+                tick = len(self.ticks) if fresh else len(self.ticks) - 1
+                self.keyframes.append((tick, len(self.records), fresh))
+                self.records.append((Replay.Round, fresh, seed,
+                    scores.unpack_from(buf, ofs)))
+                ofs += scores.size
+            else:
+                _, t = REPLAY_TICK.unpack_from(buf, ofs)
+                ofs += REPLAY_TICK.size
+                self.ticks.append(len(self.records))
+                self.records.append((Replay.Tick, t, bits.unpack_from(buf, ofs)))
+                ofs += bits.size
+    
+    def close(self):
+        if self.record:
+            self.f.close()
+    
+    def round(self, profiles, fresh):
+        """Seed for the next round's World; also sets scores on playback."""
+        if self.record:
+            if self.n is None:
+                self.n = len(profiles)
+                self.f.write(REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION,
+                    self.n, self.arena))
+            seed = random.getrandbits(64)
+            self.f.write(REPLAY_ROUND.pack(Replay.Round, fresh, seed))
+            self.f.write(struct.pack('<%dH' % self.n, *[p.score for p in profiles]))
+            return seed
+        _, _, seed, scores = self.records[self.pos]
+        self.pos += 1
+        for p, score in zip(profiles, scores):
+            p.score = score
+        return seed
+    
+    def tick(self, t, profiles):
+        """Saves this tick's inputs, or replaces them with the recorded ones."""
+        if self.record:
+            self.f.write(REPLAY_TICK.pack(Replay.Tick, t))
+            self.f.write(struct.pack('<%dB' % self.n, *[p.input for p in profiles]))
+            return
+        _, _, bits = self.records[self.pos]
+        self.pos += 1
+        for p, b in zip(profiles, bits):
+            p.input = b
+    
+    def t(self, tick):
+        return self.records[self.ticks[tick]][1]
+    
+    def resume(self, game, tick):
+        """
+        Starts game.mode at the newest keyframe at or before 'tick'.
+        Returns the first tick still to be played.
+        """
+        frame, pos, fresh = max(k for k in self.keyframes if k[0] <= tick)
+        self.pos = pos
+        # the recorded players, not however many this Engine started with
+        game.arena = self.arena
+        game.init_profiles(self.n)
+        game.mode = GameMode(game)
+        if fresh:
+            return frame
+        # the round began partway through this tick, finish it
+        _, t, bits = self.records[self.ticks[frame]]
+        for p, b in zip(game.profiles, bits):
+            p.input = b
+        game.mode.advance(t)
+        return frame + 1
+
 class Mode(object):
     def __init__(self):
         pass
@@ -1392,17 +2688,41 @@ class GameMode(Mode):
         self.game = game
         
         self.guys = []
+        self.ticks = 0 # ticks played
         self.reset()
  
         self.game.play(self.game.play_snd)
 
         if net.client:
             net.on_packet.connect(self.event, "game")
+        if net.server:
+            net.on_connect.connect(self.connect, "game")
+            net.on_disconnect.connect(self.disconnect, "game")
+
+    def connect(self, peer):
+        if peer.spectator:
+            # late spectators start watching from this round's layout
+            net.send(peer, Msg.NEXT, self.game.num_profiles(), net.seed, 0xFF)
+        else:
+            print "%s: server full." % peer
+            net.call(peer.peer.disconnect_later)
+
+    def disconnect(self, peer):
+        if peer.spectator:
+            return
+        if filter(lambda p: p != peer and not p.spectator, net.peers):
+            return
+        # all players left, wait for the next match
+        for guy in self.guys:
+            net.on_packet.disconnect("guy" + str(guy.profile.num))
+        net.on_connect.disconnect("game")
+        net.on_disconnect.disconnect("game")
+        self.game.mode = PregameMode(self.game)
 
     def event(self, ev, data, peer):
         if ev == Net.Event.SPAWN:
             pos = Vector2()
-            (item_id, pos.x, pos.y) = struct.unpack('=Bff', data)
+            (item_id, pos.x, pos.y) = Msg.SPAWN.read(data)
             self.world.clear(pos)
             if item_id != Item.NoItem:
                 # print("item_id:")
@@ -1414,7 +2734,7 @@ class GameMode(Mode):
                 # print(item)
                 self.world.attach(item)
         elif ev == Net.Event.NEXT:
-            (_, seed, player_score) = struct.unpack('BBB', data)
+            (_, seed, player_score) = Msg.NEXT.read(data)
             net.seed = seed
             if player_score != 0xFF:
                 self.game.profiles[player_score].score += 1
@@ -1424,30 +2744,28 @@ class GameMode(Mode):
         if not net.server:
             return
         net.generate_seed()
-        net.broadcast(
-            Net.Event.NEXT,
-            struct.pack('BBB',self.game.num_profiles(), net.seed, player_score),
-            enet.PACKET_FLAG_RELIABLE
-        )
+        net.broadcast(Msg.NEXT, self.game.num_profiles(), net.seed, player_score)
 
+    @trace.traced('GameMode.reset')
     def reset(self):
         
-        self.world = World(self.game)
+        seed = None
+        if self.game.replay:
+            seed = self.game.replay.round(self.game.profiles, self.ticks == 0)
+        self.world = World(self.game, seed)
         
         for guy in self.guys:
             if guy:
                guy.attached = False
+               net.on_packet.disconnect("guy" + str(guy.profile.num))
         
         self.clean()
         
         self.guys = []
         self.sessions = []
-        spawns = (
-            (TILE_SZ*1.0, TILE_SZ*1.0),
-            ((self.world.w-2)*TILE_SZ*1.0, (self.world.h-2)*TILE_SZ*1.0),
-            (TILE_SZ*1.0, (self.world.h-2)*TILE_SZ*1.0),
-            ((self.world.w-2)*TILE_SZ*1.0, TILE_SZ*1.0)
-        )
+        self.focus = None # where the view follows to in an arena
+        spawns = map(lambda x: (x[0]*TILE_SZ*1.0, x[1]*TILE_SZ*1.0),
+            self.world.spawns())
  
         for i in range(len(self.game.profiles)):
             if self.game.profiles[i]:
@@ -1455,6 +2773,10 @@ class GameMode(Mode):
                 self.guys.append(g)
                 self.world.attach(g)
         
+        if not self.game.memory.reset():
+            self.game.status = 1
+            self.game.done = True
+        
     def clean(self):
         self.world.objects = filter(lambda o: o.attached, self.world.objects)
         
@@ -1463,7 +2785,15 @@ class GameMode(Mode):
         if net.online:
             net.poll()
         
-        self.world.logic()
+        with trace.span('input'):
+            for profile in self.game.profiles:
+                profile.poll()
+            if self.game.replay:
+                self.game.replay.tick(t, self.game.profiles)
+        self.ticks += 1
+        
+        with trace.span('World.logic'):
+            self.world.logic(t)
 
         # end condition
         if not net.client:
@@ -1477,10 +2807,15 @@ class GameMode(Mode):
                 self.on_reset(guys_left[0].profile.num)
                 self.reset()
         
+        with trace.span('GameMode.advance'):
+            self.advance(t)
+    
+    def advance(self, t):
+        """Moves every object along, after the round's end was checked."""
         self.clean()
         for obj in self.world.objects:
             obj.logic(t)
-        self.world.objects.sort(cmp=render_order)
+        self.world.objects.sort(key=render_order)
     
     def render(self):
         if net.server:
@@ -1495,39 +2830,54 @@ class GameMode(Mode):
             pos = ((i+1)*SCREEN_SZ[0]/(len(self.game.profiles)+1), SCREEN_SZ[1] - self.game.font_size)
             text_center(scr, f, str(p.score), col=p.color, n=0, pos=pos)
             i += 1
-        self.world.render((0.0, 0.0))
+        self.world.render(self.view())
+    
+    def view(self):
+        """
+        Top left of the part of the world on screen: all of it, unless it's
+        an arena bigger than the screen, then centered on our guy (or the
+        first one left standing) and kept inside the world.
+        """
+        w, h = SCREEN_SZ[0], SCREEN_SZ[1] - TILE_SZ # scores below
+        world = self.world
+        if world.w*TILE_SZ <= w and world.h*TILE_SZ <= h:
+            return Vector2()
+        guys = filter(lambda g: g.attached, self.guys)
+        guys = filter(lambda g: not g.dummy, guys) or guys
+        if guys:
+            self.focus = guys[0].pos + Vector2(TILE_SZ/2.0, TILE_SZ/2.0)
+        if self.focus is None:
+            self.focus = Vector2(world.w*TILE_SZ/2.0, world.h*TILE_SZ/2.0)
+        return Vector2(
+            max(0, min(int(self.focus.x - w/2.0), world.w*TILE_SZ - w)),
+            max(0, min(int(self.focus.y - h/2.0), world.h*TILE_SZ - h)))
 
 class PregameMode(Mode):
     def __init__(self, game):
-        self.player_id = 0
+        self.player_id = -1 if net.spectator else 0
         self.game = game
         if net.client:
-            self.progress = "Connecting to %s..." % sys.argv[1]
+            self.progress = "Connecting to %s..." % net.client
             net.on_packet.connect(self.event, "pregame")
         else: 
             self.game.init_profiles(0)
-            net.on_connect.connect(self.connect)
+            net.on_connect.connect(self.connect, "pregame")
 
     def connect(self, peer):
+        if peer.spectator:
+            return # gets NEXT like everyone else when the match starts
         if self.game.add_profile(peer):
             # send player info to client
             player_id = self.game.num_profiles()-1
             peer.player_id = player_id
-            buf = struct.pack('B', player_id)
-            net.send(peer, Net.Event.INFO, buf, enet.PACKET_FLAG_RELIABLE)
-        else:
-            assert False # TEMP
+            net.send(peer, Msg.INFO, PROTOCOL_VERSION, player_id, map_crc())
         if self.game.full():
             # send game start message, and go!
             net.generate_seed()
             player_score = 0xFF
-            net.broadcast(
-                Net.Event.NEXT,
-                struct.pack('BBB',self.game.num_profiles(), net.seed, player_score),
-                enet.PACKET_FLAG_RELIABLE
-            )
+            net.broadcast(Msg.NEXT, self.game.num_profiles(), net.seed, player_score)
+            net.on_connect.disconnect("pregame")
             self.game.mode = GameMode(self.game)
-            net.on_packet.disconnect("pregame")
         
     def logic(self, t):
         if net.online:
@@ -1541,15 +2891,28 @@ class PregameMode(Mode):
 
     def event(self, ev, buf, peer):
         if ev == Net.Event.NEXT:
-            tup = struct.unpack('BBB', buf[:3])
+            tup = Msg.NEXT.read(buf)
             net.seed = tup[1]
             # player_score = tup[2]
             self.game.init_online_profile(tup[0], self.player_id)
             self.game.mode = GameMode(self.game)
         elif ev == Net.Event.INFO:
-            tup = struct.unpack('B', buf[:1])
-            buf = buf[1:]
-            self.player_id = tup[0]
+            (version,) = struct.unpack_from('B', buf) # first in every INFO
+            if version != PROTOCOL_VERSION:
+                print "Server speaks protocol %d, this client %d." % (
+                    version, PROTOCOL_VERSION)
+                self.game.status = 1
+                self.game.done = True
+                return
+            (_, self.player_id, crc) = Msg.INFO.read(buf)
+            if crc != map_crc():
+                print "Server plays map %08x, this client %08x." % (
+                    crc, map_crc())
+                self.game.status = 1
+                self.game.done = True
+        elif ev == Net.Event.REDIRECT:
+            (port,) = Msg.REDIRECT.read(buf)
+            net.redirect(port)
 
 def text(scr, font, text, n=1, col=(0xFF,0xFF,0xFF), pos=(0,0), shadow=None):
     if net.server:
@@ -1597,7 +2960,7 @@ class MenuMode(Mode):
             # "join",
             # "host",
             # text, current, min, max ([min,max])
-            ["players: %s", 4, 2, 4],
+            ["players: %s", game.arena or 4, 2, game.arena or 4],
             "quit"
         ]
         
@@ -1687,6 +3050,257 @@ def index(col, i):
     except:
         return None
 
+class TickStats(object):
+    """Server tick timing: duration, overruns and scheduling jitter."""
+    def __init__(self, step):
+        self.step = step
+        self.reset()
+
+    def reset(self):
+        self.ticks = 0
+        self.busy = 0.0
+        self.max_busy = 0.0
+        self.jitter = 0.0
+        self.max_jitter = 0.0
+        self.overruns = 0
+        self.skipped = 0
+        self.since = time.time()
+
+    def add(self, busy, late):
+        self.ticks += 1
+        self.busy += busy
+        self.max_busy = max(self.max_busy, busy)
+        self.jitter += late
+        self.max_jitter = max(self.max_jitter, late)
+        if busy > self.step:
+            self.overruns += 1
+
+    def as_dict(self):
+        n = max(self.ticks, 1)
+        return {
+            'rate': self.ticks / max(time.time() - self.since, EPSILON),
+            'avg_ms': self.busy / n * 1000.0,
+            'max_ms': self.max_busy * 1000.0,
+            'jitter_ms': self.jitter / n * 1000.0,
+            'max_jitter_ms': self.max_jitter * 1000.0,
+            'overruns': self.overruns,
+            'skipped': self.skipped
+        }
+
+    def __str__(self):
+        n = max(self.ticks, 1)
+        return "tick: %.1f Hz, %.2f ms avg (%.2f max), " \
+            "jitter %.2f ms avg (%.2f max), %d overruns, %d skipped" % (
+            self.ticks / max(time.time() - self.since, EPSILON),
+            self.busy / n * 1000.0, self.max_busy * 1000.0,
+            self.jitter / n * 1000.0, self.max_jitter * 1000.0,
+            self.overruns, self.skipped
+        )
+
+class Memory(object):
+    """
+    Memory accounting (--mem): the process's resident memory, surface
+    bytes per subsystem, live entities per class (and how many of those
+    are no longer in the world) and signal slots.  --mem=heap adds an
+    estimate of the gc tracked Python objects, which walks the whole heap.
+    Reported with F8, on the stats socket and at every round reset, where
+    the resident total is checked against --mem-budget=MB.
+    """
+    def __init__(self, game):
+        self.game = game
+        self.budget = float(option('mem-budget', 0)) * 1024 * 1024
+        self.enabled = bool(option('mem')) or bool(self.budget)
+        self.objects = option('mem') == 'heap'
+        self.rounds = 0
+        self.baseline = None # total at the first reset
+
+    @staticmethod
+    def surface_bytes(surfaces, seen):
+        n = 0
+        for s in surfaces:
+            if not isinstance(s, pygame.Surface) or id(s) in seen:
+                continue
+            seen.add(id(s))
+            if s.get_parent() is None: # subsurfaces share their parent's pixels
+                n += s.get_pitch() * s.get_height()
+        return n
+
+    @staticmethod
+    def surfaces_of(obj):
+        for v in vars(obj).values():
+            if isinstance(v, pygame.Surface):
+                yield v
+            elif isinstance(v, (list, tuple)):
+                for s in v:
+                    yield s
+
+    def surfaces(self):
+        seen = set()
+        d = OrderedDict()
+        if net.server:
+            return d
+        game = self.game
+        d['screen'] = self.surface_bytes([pygame.display.get_surface()] +
+            list(self.surfaces_of(game.screen)), seen)
+        world = getattr(game, 'world', None)
+        if world:
+            d['world'] = self.surface_bytes(self.surfaces_of(world), seen)
+            d['guys'] = self.surface_bytes((s for o in world.objects
+                if isinstance(o, Guy) for s in self.surfaces_of(o)), seen)
+            d['other'] = self.surface_bytes((s for o in world.objects
+                for s in self.surfaces_of(o)), seen)
+        return d
+
+    def entities(self):
+        gc.collect()
+        live = {}
+        for o in gc.get_objects():
+            if isinstance(o, Object) and not isinstance(o, Screen):
+                live[type(o).__name__] = live.get(type(o).__name__, 0) + 1
+        world = getattr(self.game, 'world', None)
+        in_world = {}
+        for o in (world.objects if world else []):
+            in_world[type(o).__name__] = in_world.get(type(o).__name__, 0) + 1
+        return dict((name, {'live': n, 'stale': n - in_world.get(name, 0)})
+            for name, n in live.iteritems())
+
+    @staticmethod
+    def signals():
+        return dict((name, sum(len(f) for f in getattr(net, name).slots.values()))
+            for name in ('on_connect', 'on_disconnect', 'on_packet'))
+
+    @staticmethod
+    def resident():
+        """
+        Bytes the process has in memory, strings, surfaces and numpy
+        buffers included.
+        """
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * resource.getpagesize()
+        except (IOError, IndexError, ValueError):
+            # no /proc: the peak so far, in KB on Linux and the BSDs
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    @staticmethod
+    def heap():
+        """Rough size of the gc tracked objects (not strings or buffers)."""
+        objects = gc.get_objects()
+        return {'objects': len(objects),
+            'bytes': sum(sys.getsizeof(o) for o in objects)}
+
+    def as_dict(self):
+        total = self.resident()
+        d = {
+            'total': total,
+            'growth': total - self.baseline if self.baseline else 0,
+            'surfaces': self.surfaces(),
+            'entities': self.entities(),
+            'signals': self.signals()
+        }
+        if self.objects:
+            d['heap'] = self.heap()
+        return d
+
+    def dump(self, label="memory"):
+        d = self.as_dict()
+        print "%s: %.1f MB resident (%+.1f MB), surfaces %s" % (
+            label, d['total'] / 1048576.0, d['growth'] / 1048576.0,
+            ", ".join("%s %.1f MB" % (k, v / 1048576.0)
+                for k, v in d['surfaces'].iteritems()) or "none")
+        print "  entities: " + ", ".join("%s %d (%d stale)" % (
+            name, e['live'], e['stale']) for name, e in sorted(d['entities'].items()))
+        print "  signal slots: " + ", ".join("%s %d" % x
+            for x in sorted(d['signals'].items()))
+        if 'heap' in d:
+            print "  python objects: %d, %.1f MB" % (
+                d['heap']['objects'], d['heap']['bytes'] / 1048576.0)
+        return d
+
+    def reset(self):
+        """Called at each round reset: reports and checks the budget."""
+        if not self.enabled:
+            return True
+        self.rounds += 1
+        d = self.dump("round %d memory" % self.rounds)
+        if self.baseline is None:
+            self.baseline = d['total']
+        if self.budget and d['total'] > self.budget:
+            print "Memory budget of %.1f MB exceeded." % (self.budget / 1048576.0)
+            return False
+        return True
+
+class Sampler(object):
+    """
+    Hitch catcher (--hitch[=MS]): a SIGPROF timer samples the main
+    thread's stack every SAMPLE_INTERVAL of CPU time, and when a frame
+    takes longer than MS (HITCH_BUDGET by default) that frame's samples
+    are written as collapsed stacks (flamegraph.pl, speedscope) to
+    --hitch-dir=DIR, at most once per HITCH_INTERVAL.
+    """
+    def __init__(self):
+        budget = option('hitch')
+        self.enabled = bool(budget)
+        self.budget = (HITCH_BUDGET if budget is True else float(budget or 0)) * 0.001
+        self.path = option('hitch-dir', 'hitches')
+        self.samples = [] # stacks of code objects, innermost first
+        self.start = None
+        self.last = 0.0 # time of the last dump
+        self.skipped = 0 # hitches not dumped since then
+        if self.enabled:
+            signal.signal(signal.SIGPROF, self.sample)
+            signal.siginterrupt(signal.SIGPROF, False)
+            signal.setitimer(signal.ITIMER_PROF, SAMPLE_INTERVAL, SAMPLE_INTERVAL)
+            atexit.register(self.stop)
+    
+    def stop(self):
+        # a SIGPROF after the handler is torn down would kill the process
+        signal.setitimer(signal.ITIMER_PROF, 0)
+    
+    def sample(self, signum, frame):
+        stack = []
+        while frame:
+            stack.append(frame.f_code)
+            frame = frame.f_back
+        self.samples.append(tuple(stack))
+    
+    def begin(self):
+        """Starts a frame, forgetting the last one's samples."""
+        if self.enabled:
+            self.start = time.time()
+            del self.samples[:]
+    
+    def end(self):
+        if not self.enabled or self.start is None:
+            return
+        now = time.time()
+        took = now - self.start
+        if took <= self.budget:
+            return
+        if now - self.last < HITCH_INTERVAL:
+            self.skipped += 1
+            return
+        self.last = now
+        self.dump(took)
+        self.skipped = 0
+    
+    def dump(self, took):
+        counts = {}
+        for stack in self.samples:
+            counts[stack] = counts.get(stack, 0) + 1
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        fn = os.path.join(self.path, 'hitch-%s-%dms.folded' % (
+            time.strftime('%Y%m%d-%H%M%S'), took * 1000.0))
+        with open(fn, 'w') as f:
+            for stack, n in counts.iteritems():
+                f.write(';'.join('%s (%s:%d)' % (code.co_name,
+                    os.path.basename(code.co_filename), code.co_firstlineno)
+                    for code in reversed(stack)))
+                f.write(' %d\n' % n)
+        print "%.0f ms frame, %d stack samples in %s (%d hitches skipped)." % (
+            took * 1000.0, len(self.samples), fn, self.skipped)
+
 class Engine:
     def __init__(self):
         pygame.init()
@@ -1715,19 +3329,28 @@ class Engine:
             joy.init()
             self.joys += [Joystick(i, joy)]
             idx+=1
+        self.joys_by_num = dict((j.num, j) for j in self.joys)
 
-        self.init_profiles(4)
+        self.arena = arena_players()
+        self.init_profiles(self.arena or 4)
         
         pygame.display.set_caption(TITLE)
         
         if not net.server:
-            self.screen = Screen(pygame.display.set_mode(SCALED_SZ, pygame.DOUBLEBUF), sz=SCREEN_SZ)
+            if option('renderer') and video:
+                # the display stays hidden, images still convert() to it
+                pygame.display.set_mode(SCALED_SZ, pygame.HIDDEN)
+                self.screen = RendererScreen(sz=SCREEN_SZ)
+            else:
+                if option('renderer'):
+                    print "pygame._sdl2 is unavailable, drawing with surfaces."
+                self.screen = Screen(pygame.display.set_mode(SCALED_SZ, pygame.DOUBLEBUF), sz=SCREEN_SZ)
         self.font_size = SCALED_SZ[0]/100
         self.font = pygame.font.Font(FONT, self.font_size)
         self.clock = pygame.time.Clock()
-        self.keys = []
-        if len(sys.argv) >= 2:
-            self.level = sys.argv[1]
+        self.keys = set()
+        if len(ARGS) >= 1:
+            self.level = ARGS[0]
         else:
             self.level = 1
         
@@ -1738,6 +3361,15 @@ class Engine:
             
             self.next_chan = 0
         
+        self.on_tick = Signal() # (TickStats), every server tick
+        self.memory = Memory(self)
+        net.telemetry.memory = self.memory
+        self.status = 0 # exit status
+        self.replay = None # Replay being recorded or played
+        self.sampler = Sampler()
+        if option('record') and net.local:
+            self.replay = Replay(option('record'), record=True)
+
         if net.local:
             self.mode = MenuMode(self)
         else:
@@ -1783,71 +3415,622 @@ class Engine:
         return False
         
     def full(self):
-        return len(self.profiles) == 2
+        return len(self.profiles) == (self.arena or MATCH_PLAYERS)
         
     def __call__(self):
         
         self.done = False
+        if net.server:
+            return self.serve()
         while True:
             t = self.clock.tick(60)*0.001
+            self.sampler.begin()
             self.logic(t)
             if self.done:
                 break
             if not net.server:
                 self.render()
                 self.draw()
-        
-        return 0
+            self.sampler.end()
+        
+        if self.replay:
+            self.replay.close()
+        return self.status
+
+    def serve(self):
+        """
+        Server loop: ticks the simulation at a fixed rate and sleeps in the
+        ENet host until the next tick is due instead of spinning.
+        """
+        step = 1.0 / float(option('tick', TICK_RATE))
+        self.tick_stats = TickStats(step)
+        net.telemetry.tick = self.tick_stats
+        last = deadline = time.time()
+        report = last + STATS_INTERVAL
+        while not self.done:
+            now = time.time()
+            while now < deadline:
+                net.poll(int(math.ceil((deadline - now) * 1000.0)))
+                now = time.time()
+            
+            self.sampler.begin()
+            self.logic(now - last)
+            self.sampler.end()
+            last = now
+            busy = time.time() - now
+            self.tick_stats.add(busy, now - deadline)
+            self.on_tick(self.tick_stats)
+            
+            deadline += step
+            if now - deadline > MAX_TICK_LAG:
+                # too far behind to catch up, drop the missed ticks
+                missed = int((now - deadline) / step)
+                self.tick_stats.skipped += missed
+                deadline += missed * step
+
+            if now >= report:
+                if option('stats'):
+                    print self.tick_stats
+                self.tick_stats.reset()
+                report = now + STATS_INTERVAL
+        
+        return self.status
        
+    @trace.traced('Engine.logic')
     def logic(self, t):
         
-        for ev in pygame.event.get():
-            if ev.type == pygame.QUIT:
-                self.done = True
-            elif ev.type == pygame.KEYDOWN:
-                if ev.key == pygame.K_ESCAPE:
+        with trace.span('events'):
+            for ev in pygame.event.get():
+                if ev.type == pygame.QUIT:
                     self.done = True
-                # elif ev.key == pygame.K_r:
-                #     self.reset()
-                if ev.key not in self.keys:
-                    self.keys += [ev.key]
-                if ev.key == pygame.K_PAGEUP:
-                    self.world.next_level = True
-            elif ev.type == pygame.KEYUP:
-                try:
-                    self.keys.remove(ev.key)
-                except ValueError:
-                    pass
-            elif ev.type == pygame.JOYAXISMOTION:
-                j = filter(lambda j: j.num == ev.joy, self.joys)[0]
-                j.axis(ev.axis, ev.value)
-            elif ev.type == pygame.JOYHATMOTION:
-                j = filter(lambda j: j.num == ev.joy, self.joys)[0]
-                j.hat(ev.hat*4, ev.value[0] == -1)
-                j.hat(ev.hat*4+1, ev.value[0] == 1)
-                j.hat(ev.hat*4+2, ev.value[1] == 1)
-                j.hat(ev.hat*4+3, ev.value[1] == -1)
-            elif ev.type == pygame.JOYBUTTONUP:
-                j = filter(lambda j: j.num == ev.joy, self.joys)[0]
-                j.btn(ev.button, False)
-            elif ev.type == pygame.JOYBUTTONDOWN:
-                j = filter(lambda j: j.num == ev.joy, self.joys)[0]
-                j.btn(ev.button, True)
-        
-        self.mode.logic(t)
+                elif ev.type == getattr(pygame, 'WINDOWCLOSE', None):
+                    self.done = True # RendererScreen's window, display is hidden
+                elif ev.type == pygame.KEYDOWN:
+                    if ev.key == pygame.K_ESCAPE:
+                        self.done = True
+                    # elif ev.key == pygame.K_r:
+                    #     self.reset()
+                    self.keys.add(ev.key)
+                    if ev.key == pygame.K_PAGEUP:
+                        self.world.next_level = True
+                    if ev.key == pygame.K_F8:
+                        self.memory.dump()
+                    if ev.key == pygame.K_F9 and trace.enabled:
+                        trace.write()
+                elif ev.type == pygame.KEYUP:
+                    self.keys.discard(ev.key)
+                elif ev.type in (pygame.JOYAXISMOTION, pygame.JOYHATMOTION,
+                    pygame.JOYBUTTONUP, pygame.JOYBUTTONDOWN):
+                    self.joy_event(ev)
+        
+        with trace.span('mode'):
+            self.mode.logic(t)
+
+        if net.online:
+            with trace.span('Net.flush'):
+                net.flush()
+    
+    def joy_event(self, ev):
+        j = self.joys_by_num.get(ev.joy)
+        if not j:
+            return
+        if ev.type == pygame.JOYAXISMOTION:
+            j.axis(ev.axis, ev.value)
+        elif ev.type == pygame.JOYHATMOTION:
+            j.hat(ev.hat*4, ev.value[0] == -1)
+            j.hat(ev.hat*4+1, ev.value[0] == 1)
+            j.hat(ev.hat*4+2, ev.value[1] == 1)
+            j.hat(ev.hat*4+3, ev.value[1] == -1)
+        elif ev.type == pygame.JOYBUTTONUP:
+            j.btn(ev.button, False)
+        elif ev.type == pygame.JOYBUTTONDOWN:
+            j.btn(ev.button, True)
     
     def render(self):
         if net.server:
             return
-        self.mode.render()
+        with trace.span('render'):
+            self.mode.render()
     
     def draw(self):
         if net.server:
             return
-        self.screen.render()
-        pygame.display.flip()
+        with trace.span('flip'):
+            self.screen.render()
+
+class FrontDoor(object):
+    """
+    Sharded server (-s --workers=N): this process only accepts connections
+    on PORT and hands each new match to one of N worker processes, each a
+    normal server with its own ENet host on WORKER_PORT + n.  Workers
+    report their load over a pipe and new matches go to the least loaded
+    idle worker; players wait here while every worker is busy.
+    """
+
+    class Worker(object):
+        def __init__(self, num):
+            self.num = num
+            self.port = WORKER_PORT + num
+            self.pipe, child = multiprocessing.Pipe()
+            self.process = multiprocessing.Process(
+                target=FrontDoor.work, args=(num, child))
+            self.process.daemon = True
+            self.process.start()
+            self.players = 0
+            self.tick = {}
+            self.reserved = 0.0 # a placed match is expected until then
+
+        def busy(self):
+            return self.players > 0 or time.time() < self.reserved
+
+        def poll(self):
+            while self.pipe.poll():
+                try:
+                    self.players, self.tick = self.pipe.recv()
+                except EOFError: # the worker died
+                    self.players, self.tick = 0, {}
+                    return
+                if self.players:
+                    self.reserved = 0.0 # they made it
+
+    def __init__(self, workers):
+        self.workers = [FrontDoor.Worker(i) for i in xrange(workers)]
+        self.waiting = [] # players not yet placed, in order of arrival
+        self.watched = None # worker spectators are sent to
+        net.on_connect.connect(self.connect, "frontdoor")
+        net.on_disconnect.connect(self.disconnect, "frontdoor")
+        net.telemetry.tick = self
+
+    @staticmethod
+    def work(num, pipe):
+        # forked with the front door's sockets; replace them with our own
+        net.listen(WORKER_PORT + num)
+        net.telemetry = Telemetry(net, STATS_PORT + 1 + num)
+        engine = Engine()
+        report = [0.0]
+        def load(tick_stats):
+            now = time.time()
+            if now >= report[0]:
+                players = len(filter(lambda p: not p.spectator, net.peers))
+                pipe.send((players, tick_stats.as_dict()))
+                report[0] = now + LOAD_INTERVAL
+        engine.on_tick.connect(load)
+        return engine()
+
+    def connect(self, peer):
+        if peer.spectator:
+            self.redirect(peer, self.watched or self.workers[0])
+        else:
+            self.waiting += [peer]
+
+    def disconnect(self, peer):
+        self.waiting = filter(lambda p: p != peer, self.waiting)
+
+    def redirect(self, peer, worker):
+        net.send(peer, Msg.REDIRECT, worker.port)
+        net.flush() # queue it with enet ahead of the disconnect
+        net.call(peer.peer.disconnect_later)
+
+    def place(self):
+        players = arena_players() or MATCH_PLAYERS
+        while len(self.waiting) >= players:
+            idle = filter(lambda w: not w.busy() and w.process.is_alive(),
+                self.workers)
+            if not idle:
+                return
+            worker = min(idle, key=lambda w: w.tick.get('avg_ms', 0.0))
+            match = self.waiting[:players]
+            self.waiting = self.waiting[players:]
+            for peer in match:
+                self.redirect(peer, worker)
+            worker.reserved = time.time() + 5.0
+            self.watched = worker
+            print "Match placed on worker %d (port %d)." % (
+                worker.num, worker.port)
+
+    def as_dict(self):
+        # stands in for TickStats in telemetry: the workers' tick times
+        ticks = [w.tick for w in self.workers if w.tick]
+        return {
+            'avg_ms': sum(t['avg_ms'] for t in ticks) / max(len(ticks), 1),
+            'max_ms': max([t['max_ms'] for t in ticks] or [0.0]),
+            'workers': [{'port': w.port, 'players': w.players, 'tick': w.tick}
+                for w in self.workers]
+        }
+
+    def __call__(self):
+        print "Front door on port %d, %d workers." % (PORT, len(self.workers))
+        while any(w.process.is_alive() for w in self.workers):
+            net.poll(int(LOAD_INTERVAL * 100))
+            for worker in self.workers:
+                worker.poll()
+            self.place()
+            net.flush()
+        print "All workers exited."
+        return 1
+
+class Relay(object):
+    """
+    Spectator relay: connects to a game server as a single read-only
+    peer and re-broadcasts its stream to any number of spectators, delayed
+    by --delay seconds and batched into one packet per relay tick.
+    """
+    def __init__(self, address):
+        self.delay = float(option('delay', RELAY_DELAY))
+        self.step = 1.0 / float(option('tick', RELAY_RATE))
+        self.address = address
+        # room for a second connection while being redirected
+        self.upstream = enet.Host(None, 2, CHANNELS, 0, 0)
+        self.server = self.upstream.connect(
+            enet.Address(address, PORT), CHANNELS, Net.SPECTATE)
+        self.host = enet.Host(enet.Address(b"0.0.0.0", RELAY_PORT),
+            RELAY_PEERS, CHANNELS, 0, 0)
+        self.spectators = 0
+        self.pending = deque() # (time, flags, data) not yet due
+        self.round = [] # reliable messages since the last NEXT
+        self.relayed = 0 # bytes sent
+        self.done = False
+
+    def receive(self, data, flags):
+        sz, ev = MSG_HEADER.unpack_from(data)
+        if ev == Net.Event.REDIRECT:
+            # a sharded server's front door, follow it to the match
+            (port,) = Msg.REDIRECT.read(data, MSG_HEADER.size)
+            print "Redirected to port %d." % port
+            self.server = self.upstream.connect(
+                enet.Address(self.address, port), CHANNELS, Net.SPECTATE)
+            return
+        self.pending.append((time.time(), flags, data))
+
+    def log(self, data, flags):
+        if not flags & enet.PACKET_FLAG_RELIABLE:
+            return
+        # keep this round's reliable messages for spectators joining late
+        ofs = 0
+        while ofs < len(data):
+            sz, ev = MSG_HEADER.unpack_from(data, ofs)
+            end = ofs + MSG_HEADER.size + sz
+            if ev == Net.Event.NEXT:
+                self.round = []
+            self.round += [data[ofs:end]]
+            ofs = end
+
+    def service(self, host, timeout=0):
+        event = host.service(timeout)
+        while event.type != enet.EVENT_TYPE_NONE:
+            if host is self.upstream:
+                if event.type == enet.EVENT_TYPE_CONNECT:
+                    print "Relaying %s." % event.peer.address
+                elif event.type == enet.EVENT_TYPE_DISCONNECT:
+                    if event.peer.incomingPeerID == self.server.incomingPeerID:
+                        print "Server disconnected."
+                        self.done = True
+                elif event.type == enet.EVENT_TYPE_RECEIVE:
+                    self.receive(event.packet.data, event.packet.flags)
+            else:
+                if event.type == enet.EVENT_TYPE_CONNECT:
+                    self.spectators += 1
+                    if self.round:
+                        event.peer.send(0, enet.Packet(b''.join(self.round),
+                            enet.PACKET_FLAG_RELIABLE))
+                elif event.type == enet.EVENT_TYPE_DISCONNECT:
+                    self.spectators -= 1
+                # spectators have nothing to say
+            event = host.service(0)
+
+    def flush(self):
+        # everything due this tick goes out as one packet per flags
+        due = time.time() - self.delay
+        batches = OrderedDict()
+        while self.pending and self.pending[0][0] <= due:
+            _, flags, data = self.pending.popleft()
+            batches.setdefault(flags, []).append(data)
+            self.log(data, flags)
+        for flags, batch in batches.iteritems():
+            buf = b''.join(batch)
+            self.host.broadcast(Net.channel(flags), enet.Packet(buf, flags))
+            self.relayed += len(buf) * self.spectators
+        self.host.flush()
+
+    def __call__(self):
+        sockets = [self.upstream.socket.fileno(), self.host.socket.fileno()]
+        deadline = time.time()
+        report = deadline + STATS_INTERVAL
+        while not self.done:
+            now = time.time()
+            while now < deadline:
+                select.select(sockets, [], [], deadline - now)
+                self.service(self.upstream)
+                self.service(self.host)
+                now = time.time()
+            self.flush()
+            deadline = max(deadline + self.step, now - self.step)
+            if now >= report:
+                if option('stats'):
+                    print "relay: %d spectators, %.1f KB/s" % (
+                        self.spectators, self.relayed / 1024.0 / STATS_INTERVAL)
+                self.relayed = 0
+                report = now + STATS_INTERVAL
+        return 0
+
+def percentile(samples, p):
+    if not samples:
+        return float('nan')
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * p), len(samples) - 1)]
+
+class LoadTest(object):
+    """
+    Synthetic load: many scripted headless clients on one ENet host.
+    Each follows the real handshake (INFO, then NEXT) and sends INPUT at
+    --rate per second, PLANT at --plants and TRIGGER at --triggers per
+    second.  Latency is measured from an INPUT to the MOVE acknowledging
+    it and from a PLANT to its echo; server tick time is read from the
+    server's stats socket (run it with --stats).
+
+    --clients takes a comma separated list, running one --duration second
+    trial per entry, so capacity can be read off as the load rises.  A
+    server holds one match of MATCH_PLAYERS (or --arena) players; more
+    matches, and more bots, need a sharded one (-s --workers=N).  Each
+    trial reports how many bots got to play and in how many matches.
+    """
+
+    class Bot(object):
+        def __init__(self, peer):
+            self.peer = peer
+            self.port = PORT # the match's, once redirected
+            self.player_id = None
+            self.seed = None # set by NEXT, we're playing from then on
+            self.seq = 0
+            self.bits = 0 # Input direction bits
+            self.sent = {} # input seq -> time
+            self.plants = deque() # send times of PLANTs awaiting echo
+
+    def __init__(self, address):
+        self.address = address
+        self.rate = float(option('rate', 60.0))
+        self.plants = float(option('plants', 0.5))
+        self.triggers = float(option('triggers', 0.25))
+        self.duration = float(option('duration', 10.0))
+        self.stats_port = int(option('stats-port', STATS_PORT))
+        self.host = None
+        self.left_out = 0 # bots turned away or still waiting, every trial
+
+    def reset(self, clients):
+        # twice the peers, for following a sharded server's redirects
+        self.host = enet.Host(None, clients * 2, CHANNELS, 0, 0)
+        self.bots = {}
+        for i in xrange(clients):
+            peer = self.host.connect(enet.Address(self.address, PORT), CHANNELS)
+            self.bots[peer.incomingPeerID] = LoadTest.Bot(peer)
+        self.latency = []
+        self.plant_latency = []
+        self.msgs_in = 0
+        self.msgs_out = 0
+        self.rejected = 0
+
+    def bot(self, peer):
+        return self.bots.get(peer.incomingPeerID)
+
+    def redirect(self, bot, port):
+        del self.bots[bot.peer.incomingPeerID]
+        bot.peer = self.host.connect(enet.Address(self.address, port), CHANNELS)
+        bot.port = port
+        self.bots[bot.peer.incomingPeerID] = bot
+
+    def receive(self, bot, buf):
+        now = time.time()
+        ofs = 0
+        while ofs < len(buf):
+            sz, ev = MSG_HEADER.unpack_from(buf, ofs)
+            ofs += MSG_HEADER.size
+            data = ofs
+            ofs += sz
+            self.msgs_in += 1
+            if ev == Net.Event.INFO:
+                (_, bot.player_id, _) = Msg.INFO.read(buf, data)
+            elif ev == Net.Event.NEXT:
+                (_, bot.seed, _) = Msg.NEXT.read(buf, data)
+                bot.sent.clear()
+                bot.plants.clear()
+            elif ev == Net.Event.MOVE:
+                (num, seq, _, _, _, _) = Msg.MOVE.read(buf, data)
+                t = bot.sent.pop(seq, None)
+                if num == bot.player_id and t is not None:
+                    self.latency += [now - t]
+            elif ev == Net.Event.PLANT:
+                (num, _, _) = Msg.PLANTED.read(buf, data)
+                if num == bot.player_id and bot.plants:
+                    self.plant_latency += [now - bot.plants.popleft()]
+            elif ev == Net.Event.REDIRECT:
+                (port,) = Msg.REDIRECT.read(buf, data)
+                self.redirect(bot, port)
+
+    def service(self, timeout):
+        event = self.host.service(timeout)
+        while event.type != enet.EVENT_TYPE_NONE:
+            bot = self.bot(event.peer)
+            if bot:
+                if event.type == enet.EVENT_TYPE_RECEIVE:
+                    self.receive(bot, event.packet.data)
+                elif event.type == enet.EVENT_TYPE_DISCONNECT:
+                    self.rejected += 1
+                    del self.bots[event.peer.incomingPeerID]
+            event = self.host.service(0)
+
+    def send(self, bot, t):
+        if random.random() < 0.05: # change direction now and then
+            bot.bits = random.choice((0, Input.Left, Input.Right, Input.Up, Input.Down))
+        bot.seq += 1
+        bot.sent[bot.seq] = time.time()
+        if len(bot.sent) > 256: # never acknowledged
+            del bot.sent[min(bot.sent)]
+        self.host_send(bot, [(Msg.INPUT,
+            (bot.seed & 0xFF, bot.seq, bot.bits, int(round(t * 1000.0))) +
+                (0, 0) * (INPUT_REDUNDANCY - 1))])
+        actions = []
+        if random.random() < self.plants * t:
+            actions += [(Msg.PLANT, (16.0, 16.0))]
+            bot.plants.append(time.time())
+        if random.random() < self.triggers * t:
+            actions += [(Msg.TRIGGER, ())]
+        if actions:
+            self.host_send(bot, actions)
+
+    def host_send(self, bot, msgs):
+        # one packet, so all of msgs must share enet flags
+        buf = bytearray()
+        for msg, values in msgs:
+            msg.write(buf, values)
+        bot.peer.send(msgs[0][0].channel,
+            enet.Packet(bytes(buf), msgs[0][0].flags))
+        self.msgs_out += len(msgs)
+
+    def server_tick(self):
+        try:
+            s = socket.create_connection(('127.0.0.1', self.stats_port), 1.0)
+            buf = ''
+            while True:
+                d = s.recv(65536)
+                if not d:
+                    break
+                buf += d
+            s.close()
+            return json.loads(buf).get('tick')
+        except (socket.error, ValueError):
+            return None
+
+    def trial(self, clients):
+        self.reset(clients)
+        step = 1.0 / self.rate
+        start = deadline = time.time()
+        end = start + self.duration
+        sockets = [self.host.socket.fileno()]
+        while True:
+            now = time.time()
+            while now < deadline:
+                select.select(sockets, [], [], deadline - now)
+                self.service(0)
+                now = time.time()
+            if now >= end:
+                break
+            for bot in self.bots.values():
+                if bot.seed is not None:
+                    self.send(bot, step)
+            self.host.flush()
+            deadline = max(deadline + step, now - step)
+        
+        elapsed = time.time() - start
+        tick = self.server_tick() or {}
+        playing = filter(lambda b: b.seed is not None, self.bots.values())
+        matches = len(set(b.port for b in playing))
+        self.left_out += clients - len(playing)
+        print "%7d %8d %7d %7d %9.0f %9.0f %8.1f %8.1f %8.1f %8.1f %9.2f %9.2f" % (
+            clients, self.rejected, len(playing), matches,
+            self.msgs_out / elapsed, self.msgs_in / elapsed,
+            percentile(self.latency, 0.5) * 1000.0,
+            percentile(self.latency, 0.95) * 1000.0,
+            percentile(self.latency, 0.99) * 1000.0,
+            percentile(self.plant_latency, 0.5) * 1000.0,
+            tick.get('avg_ms', float('nan')), tick.get('max_ms', float('nan')))
+        sys.stdout.flush()
+
+        for bot in self.bots.values():
+            bot.peer.disconnect_now()
+        self.host.flush()
+        self.host = None
+
+    def __call__(self):
+        print "%7s %8s %7s %7s %9s %9s %8s %8s %8s %8s %9s %9s" % (
+            'clients', 'rejected', 'playing', 'matches', 'out msg/s',
+            'in msg/s', 'p50 ms', 'p95 ms', 'p99 ms', 'plant ms', 'tick ms',
+            'tick max')
+        for clients in str(option('clients', 2)).split(','):
+            self.trial(int(clients))
+        if self.left_out:
+            print "Some clients never played: a server holds one match " \
+                "(%d players, or --arena=N), run it with --workers=N " \
+                "for more matches." % MATCH_PLAYERS
+        return 0
+
+def export_frames(job):
+    """Export worker: plays a replay offscreen and saves ticks first..last-1."""
+    fn, out, first, last = job
+    game = Engine()
+    game.replay = replay = Replay(fn)
+    tick = replay.resume(game, first)
+    if tick > first:
+        Export.save(game, out, first)
+    while tick < last:
+        game.logic(replay.t(tick))
+        if tick >= first:
+            Export.save(game, out, tick)
+        tick += 1
+    return last - first
+
+class Export(object):
+    """
+    Renders a replay to numbered images (--replay=FILE --export=DIR,
+    --format=png) with SDL's dummy video driver, the ticks split over a
+    process pool (--jobs=N, one per CPU by default).  Each process starts from the
+    round keyframe before its range, fast forwards without drawing and
+    renders its ticks through the usual World/Screen path.
+    """
+    def __init__(self, fn, out):
+        self.fn = fn
+        self.out = out
+    
+    @staticmethod
+    def save(game, out, tick):
+        game.render()
+        game.draw()
+        pygame.image.save(game.screen.surface,
+            os.path.join(out, 'frame%06d.%s' % (tick, option('format', 'png'))))
+    
+    def __call__(self):
+        if option('renderer'):
+            # frames are saved from the Screen's surface, a renderer has none
+            print "--export can't be used with --renderer."
+            return 1
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
+        os.environ['SDL_AUDIODRIVER'] = 'dummy'
+        if not os.path.isdir(self.out):
+            os.makedirs(self.out)
+        ticks = len(Replay(self.fn).ticks)
+        jobs = int(option('jobs', multiprocessing.cpu_count()))
+        # more ranges than processes, so a slow one doesn't hold up the rest
+        size = max(1, int(math.ceil(ticks / float(jobs * 4))))
+        ranges = [(self.fn, self.out, first, min(first + size, ticks))
+            for first in xrange(0, ticks, size)]
+        start = time.time()
+        pool = multiprocessing.Pool(jobs)
+        try:
+            frames = sum(pool.map(export_frames, ranges))
+        finally:
+            pool.close()
+            pool.join()
+        print "Exported %d frames to %s in %.1fs." % (
+            frames, self.out, time.time() - start)
+        return 0
 
 def main():
+    if option('map'):
+        try:
+            load_map(option('map'))
+        except (IOError, ValueError, struct.error) as e:
+            print "Can't load --map: %s" % e
+            return 1
+    if net.server and option('workers'):
+        workers = option('workers')
+        if workers is True:
+            workers = multiprocessing.cpu_count()
+        return FrontDoor(int(workers))()
+    if net.relay:
+        return Relay(net.relay)()
+    if net.loadtest:
+        return LoadTest(net.loadtest)()
+    if option('replay') and option('export'):
+        return Export(option('replay'), option('export'))()
     return Engine()()
 
 if __name__=='__main__':
@@ -0,0 +1,216 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+sys.path.insert(0, ROOT)
+os.chdir(ROOT) # data/ paths are relative
+sys.argv = [sys.argv[0]] # a local game, whatever the runner was given
+
+import numpy
+import bomberoni
+from bomberoni import TILE_SZ
+
+class RngTest(unittest.TestCase):
+    def test_random_sample_matches_one_draw_at_a_time(self):
+        for seed in (0, 12345, 2**64 - 1):
+            a, b = bomberoni.Rng(seed), bomberoni.Rng(seed)
+            sample = a.random_sample((7, 9))
+            draws = [b.random() for i in xrange(7*9)]
+            self.assertEqual(sample.ravel().tolist(), draws)
+            self.assertEqual(a.next(), b.next())
+
+class MapTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.game = bomberoni.Engine()
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.argv = sys.argv
+
+    def tearDown(self):
+        sys.argv = self.argv
+        shutil.rmtree(self.dir)
+
+    def load(self, w, h):
+        fn = os.path.join(self.dir, 'big.map')
+        tiles = bomberoni.generate_map(w, h, ((1, 1),),
+            numpy.random.RandomState(0))
+        bomberoni.save_map(fn, tiles)
+        sys.argv = [sys.argv[0], '--map=' + fn]
+        return bomberoni.World(self.game, seed=1)
+
+    def test_fire_covers_a_map_bigger_than_the_screen(self):
+        world = self.load(31, 21)
+        self.assertEqual(world.tiles.shape, (21, 31))
+        self.assertEqual(world.fire.shape, world.tiles.shape)
+        world.ignite(bomberoni.Vector2(25*TILE_SZ, 17*TILE_SZ))
+        self.assertTrue(world.burning((25*TILE_SZ, 17*TILE_SZ, 4, 4)))
+
+    def test_save_map_keeps_generating(self):
+        fn = os.path.join(self.dir, 'saved.map')
+        sys.argv = [sys.argv[0], '--save-map=' + fn]
+        first = bomberoni.World(self.game, seed=1).tiles
+        second = bomberoni.World(self.game, seed=2).tiles
+        self.assertFalse((first == second).all())
+        self.assertEqual(bomberoni.load_map(fn).tolist(), second.tolist())
+
+    def test_map_crc_tells_layouts_apart(self):
+        self.assertEqual(bomberoni.map_crc(), 0)
+        self.load(15, 11)
+        crc = bomberoni.map_crc()
+        self.load(15, 13)
+        self.assertNotEqual(bomberoni.map_crc(), crc)
+        self.assertNotEqual(crc, 0)
+
+class FlameTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.game = bomberoni.Engine()
+
+    def test_rewind_sees_flames_a_newer_one_replaced(self):
+        world = bomberoni.World(self.game, seed=1)
+        cell = bomberoni.Vector2(3*TILE_SZ, 3*TILE_SZ)
+        box = (cell.x, cell.y, 4, 4)
+        world.ignite(cell)
+        for i in xrange(30): # half a second, past the hurting frames
+            world.logic(1/60.0)
+        self.assertFalse(world.burning(box))
+        self.assertTrue(world.burning(box, 0.2))
+        world.ignite(cell) # a new flame on the same tile
+        world.logic(1/60.0)
+        self.assertTrue(world.burning(box))
+        self.assertTrue(world.burning(box, 0.2)) # the old one, still
+        self.assertFalse(world.burning(box, 0.01)) # between the two
+
+    def test_rewind_reaches_max_rewind_at_a_high_tick_rate(self):
+        world = bomberoni.World(self.game, seed=1)
+        cell = bomberoni.Vector2(3*TILE_SZ, 3*TILE_SZ)
+        box = (cell.x, cell.y, 4, 4)
+        world.ignite(cell)
+        for i in xrange(132): # 0.55 seconds at 240 ticks a second
+            world.logic(1/240.0)
+        self.assertFalse(world.burning(box))
+        self.assertTrue(world.burning(box, bomberoni.MAX_REWIND - 0.01))
+        self.assertLess(len(world.flames), 70) # not every tick forever
+
+class SweepTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.game = bomberoni.Engine()
+
+    def setUp(self):
+        self.world = bomberoni.World(self.game, seed=1)
+        self.world.tiles[:] = bomberoni.Tile.Empty
+
+    def tile(self, i, j):
+        return (i*TILE_SZ*1.0, j*TILE_SZ*1.0)
+
+    def guy(self, pos):
+        guy = bomberoni.Guy(profile=self.game.profiles[0], game=self.game,
+            mode=None, pos=pos, sz=bomberoni.TILE_SZ_T)
+        self.world.attach(guy)
+        return guy
+
+    def test_kicked_bomb_stops_at_a_guy(self):
+        guy = self.guy(self.tile(6, 5))
+        bomb = bomberoni.Bomb(game=self.game, pos=self.tile(3, 5),
+            sz=bomberoni.TILE_SZ_T, solid=True)
+        self.world.attach(bomb)
+        pos, contacts = self.world.sweep(bomb, bomberoni.Vector2(100.0, 0.0))
+        self.assertIn(guy, contacts)
+        self.assertEqual(pos.x + TILE_SZ, guy.box()[0])
+
+    def test_bomb_off_the_grid_leaves_the_world(self):
+        guy = self.guy(self.tile(3, 5))
+        bomb = bomberoni.Bomb(game=self.game, pos=self.tile(4, 5),
+            sz=bomberoni.TILE_SZ_T, solid=True, owner=guy)
+        self.world.attach(bomb)
+        bomb.pos.x = self.world.sz.x + 1.0
+        bomb.check_bounds()
+        self.assertFalse(bomb.attached)
+        self.assertNotIn(bomb, self.world.movers)
+        self.assertNotIn(bomb, self.world.bombs_of(guy))
+
+    def test_guys_walk_through_each_other(self):
+        self.guy(self.tile(6, 5))
+        guy = self.guy(self.tile(3, 5))
+        pos, contacts = self.world.sweep(guy, bomberoni.Vector2(100.0, 0.0))
+        self.assertEqual(contacts, [])
+        self.assertEqual(pos.x, 3*TILE_SZ + 100.0)
+
+    def test_guy_inside_a_wall_cant_walk_through_it(self):
+        self.world.tiles[5, 5] = bomberoni.Tile.Solid
+        guy = self.guy((5*TILE_SZ - 9.0, 5*TILE_SZ)) # 3 pixels in
+        pos, contacts = self.world.sweep(guy, bomberoni.Vector2(20.0, 0.0))
+        self.assertTrue(contacts)
+        self.assertEqual(pos.x, guy.pos.x)
+
+    def test_flames_stop_at_the_wall_they_break(self):
+        self.world.tiles[5, 6] = bomberoni.Tile.Breakable
+        self.world.tiles[5, 7] = bomberoni.Tile.Breakable
+        guy = self.guy(self.tile(1, 1))
+        guy.radius = 2
+        bomb = bomberoni.Bomb(game=self.game, pos=self.tile(5, 5),
+            sz=bomberoni.TILE_SZ_T, solid=True, owner=guy)
+        self.world.attach(bomb)
+        bomb.explode()
+        self.assertEqual(self.world.tile(6, 5), bomberoni.Tile.Empty)
+        self.assertEqual(self.world.tile(7, 5), bomberoni.Tile.Breakable)
+        self.assertTrue(self.world.burning(self.tile(6, 5) + (4, 4)))
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.dir, 'two.brpl')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def state(self, game):
+        return ([(g.pos.x, g.pos.y, g.attached) for g in game.mode.guys],
+            [p.score for p in game.profiles], len(game.mode.world.objects))
+
+    def record(self, ticks):
+        game = bomberoni.Engine()
+        game.init_profiles(2)
+        game.replay = bomberoni.Replay(self.fn, record=True)
+        game.mode = bomberoni.GameMode(game)
+        rng = numpy.random.RandomState(7)
+        states = []
+        for tick in xrange(ticks):
+            for p in game.profiles:
+                p.poll = lambda: None # inputs come from rng, not the keys
+                p.input = int(rng.randint(0, 64))
+            game.logic(1/60.0)
+            states.append(self.state(game))
+        game.replay.close()
+        return states
+
+    def play(self, first):
+        game = bomberoni.Engine()
+        game.replay = replay = bomberoni.Replay(self.fn)
+        tick = replay.resume(game, first)
+        states = {}
+        while tick < len(replay.ticks):
+            game.logic(replay.t(tick))
+            states[tick] = self.state(game)
+            tick += 1
+        return len(game.profiles), states
+
+    def test_two_player_recording_plays_back_the_same(self):
+        recorded = self.record(600)
+        for first in (0, 300):
+            n, played = self.play(first)
+            self.assertEqual(n, 2)
+            self.assertTrue(played)
+            for tick, state in played.items():
+                self.assertEqual(state, recorded[tick])
+
+if __name__ == '__main__':
+    unittest.main()